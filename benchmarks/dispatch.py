@@ -0,0 +1,98 @@
+"""Micro-benchmark of the per-request dispatch overhead in LLMDispatcher.
+
+Compares resolving the provider module and endpoint method on every call (as
+the dispatcher used to) with the callables cached on the instance records, and
+measures a full LLMDispatcher.call against a no-op endpoint.
+
+Run from the repository root: python benchmarks/dispatch.py
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import timeit
+from importlib import import_module
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "llamaxing"))
+
+MODELS = [
+    {
+        "id": f"model-{i}",
+        "aliases": [f"alias-{i}"],
+        "capabilities": ["chat_completions"],
+        "instances": [
+            {
+                "id": f"model-{i}-{j}",
+                "provider": "azure",
+                "azure_endpoint": "https://example.openai.azure.com",
+                "azure_deployment": f"model-{i}",
+                "azure_api_key": "key",
+                "azure_api_version": "2024-02-01",
+            }
+            for j in range(2)
+        ],
+    }
+    for i in range(50)
+]
+
+
+def report(name: str, timer: timeit.Timer, batch: int = 1):
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=loops)) / loops / batch
+    print(f"{name:<40} {best * 1e9:>10.0f} ns/call")
+
+
+async def noop(*args, **kwargs):
+    return None
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "models.json"), "w") as f:
+            json.dump(MODELS, f)
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            from identity import Identity
+            from llm import LLMDispatcher
+
+            dispatcher = LLMDispatcher()
+        finally:
+            os.chdir(cwd)
+
+    instance = dispatcher.get_model("alias-25").instances[0]
+    endpoint = "chat_completions"
+
+    def resolve_per_call():
+        module = import_module(f"llm.provider.{instance.params['provider']}")
+        return getattr(module.LLMProvider, endpoint)
+
+    def resolve_cached():
+        return instance.endpoints[endpoint]
+
+    report("resolve endpoint per call", timeit.Timer(resolve_per_call))
+    report("resolve endpoint from instance record", timeit.Timer(resolve_cached))
+
+    for model in dispatcher.models.values():
+        for x in model.instances:
+            x.endpoints[endpoint] = noop
+    data = {"model": "alias-25", "messages": [{"role": "user", "content": "Hi"}]}
+    identity = Identity(id="benchmark")
+    loop = asyncio.new_event_loop()
+
+    async def calls():
+        for _ in range(100):
+            await dispatcher.call(endpoint, data, identity, None)
+
+    report(
+        "LLMDispatcher.call with no-op endpoint",
+        timeit.Timer(lambda: loop.run_until_complete(calls())),
+        batch=100,
+    )
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Throughput of the JSON codec backends on representative gateway payloads.
+
+Covers a chat completion request, a streamed chat chunk, a batch embeddings
+response and an image generation response with inline base64 data. Backends
+that are not installed are skipped.
+
+Run from the repository root: python benchmarks/json_codec.py
+"""
+
+import base64
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "llamaxing"))
+
+from json_codec import BACKENDS, load_backend  # noqa: E402
+
+random.seed(0)
+
+PAYLOADS = {
+    "chat request": {
+        "model": "gpt-4",
+        "messages": [
+            {"role": "system", "content": "You are a helpful assistant."},
+            *(
+                {
+                    "role": "user" if i % 2 == 0 else "assistant",
+                    "content": "Tell me a joke about llamas. " * 20,
+                }
+                for i in range(10)
+            ),
+        ],
+        "temperature": 0.7,
+        "observation_metadata": {"session_id": "abc", "tags": ["demo"]},
+    },
+    "chat stream chunk": {
+        "id": "chatcmpl-123",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "gpt-4",
+        "choices": [
+            {"index": 0, "delta": {"content": " llama"}, "finish_reason": None}
+        ],
+    },
+    "embeddings response (16x1536)": {
+        "object": "list",
+        "model": "text-embedding-ada-002",
+        "data": [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": [random.uniform(-1, 1) for _ in range(1536)],
+            }
+            for i in range(16)
+        ],
+        "usage": {"prompt_tokens": 256, "total_tokens": 256},
+    },
+    "image response (b64_json)": {
+        "created": 1700000000,
+        "data": [
+            {
+                "b64_json": base64.b64encode(random.randbytes(1024 * 1024)).decode(),
+                "revised_prompt": "A llama wearing sunglasses",
+            }
+        ],
+    },
+}
+
+
+def throughput(func, arg, size: int) -> float:
+    timer = timeit.Timer(lambda: func(arg))
+    loops, _ = timer.autorange()
+    best = min(timer.repeat(repeat=5, number=loops)) / loops
+    return size / best / 1e6
+
+
+def main():
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(load_backend(name))
+        except ImportError:
+            print(f"{name} not installed, skipping")
+
+    print(f"{'payload':<32} {'backend':<8} {'size':>10} {'loads':>12} {'dumps':>12}")
+    for payload_name, payload in PAYLOADS.items():
+        for name, loads, dumps in backends:
+            encoded = dumps(payload)
+            size = len(encoded)
+            print(
+                f"{payload_name:<32} {name:<8} {size:>10} "
+                f"{throughput(loads, encoded, size):>7.0f} MB/s "
+                f"{throughput(dumps, payload, size):>7.0f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
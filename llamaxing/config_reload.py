@@ -0,0 +1,71 @@
+import asyncio
+import os
+import signal
+import typing
+
+from logging_utils import log_exception, logger
+
+ReloadCallable = typing.Callable[[], typing.Awaitable[None]]
+
+
+class ConfigReloader:
+    """Reloads configuration files on SIGHUP or when they change on disk."""
+
+    def __init__(self, targets: dict[str, ReloadCallable], interval: float = 0):
+        # Optional files may not be configured at all
+        self.targets = {k: v for k, v in targets.items() if k is not None}
+        self.interval = interval
+        self.mtimes = {x: self.get_mtime(x) for x in self.targets}
+        self.watch_task = None
+        self.signal_handler = False
+        self.reload_tasks = set()
+
+    @staticmethod
+    def get_mtime(filename: str) -> float | None:
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def on_startup(self):
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGHUP, self.on_signal)
+            self.signal_handler = True
+        except (AttributeError, NotImplementedError, RuntimeError):
+            logger.warning("Reloading configuration on SIGHUP is not supported")
+        if self.interval > 0:
+            self.watch_task = loop.create_task(self.watch())
+
+    async def on_shutdown(self):
+        if self.signal_handler:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+
+    def on_signal(self):
+        task = asyncio.get_running_loop().create_task(self.reload_all())
+        self.reload_tasks.add(task)
+        task.add_done_callback(self.reload_tasks.discard)
+
+    async def reload_all(self):
+        for filename in self.targets:
+            self.mtimes[filename] = self.get_mtime(filename)
+            await self.reload(filename)
+
+    async def reload(self, filename: str):
+        try:
+            await self.targets[filename]()
+        except Exception:
+            log_exception()
+            logger.error(f"Failed to reload {filename}, keeping current configuration")
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for filename in self.targets:
+                mtime = self.get_mtime(filename)
+                if mtime != self.mtimes[filename]:
+                    self.mtimes[filename] = mtime
+                    if mtime is not None:
+                        await self.reload(filename)
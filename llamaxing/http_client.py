@@ -0,0 +1,138 @@
+from time import perf_counter
+
+import httpx
+from timings import request_timings
+
+# Connection pool and timeout options, set per instance with the "http" object in
+# models.json on top of the app defaults
+HTTP_OPTIONS = (
+    "max_connections",
+    "max_keepalive_connections",
+    "keepalive_expiry",
+    "http2",
+    "connect_timeout",
+    "read_timeout",
+    "write_timeout",
+    "pool_timeout",
+)
+
+EWMA_ALPHA = 0.1
+
+
+class PoolStats:
+    """Time requests spend waiting for a connection from the pool."""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.waiting = 0
+        self.pool_timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.ewma_wait: float | None = None
+
+    def record_wait(self, wait: float):
+        self.requests += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if self.ewma_wait is None:
+            self.ewma_wait = wait
+        else:
+            self.ewma_wait = EWMA_ALPHA * wait + (1 - EWMA_ALPHA) * self.ewma_wait
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "waiting": self.waiting,
+            "pool_timeouts": self.pool_timeouts,
+            "mean_wait": self.total_wait / self.requests if self.requests else None,
+            "max_wait": self.max_wait,
+            "ewma_wait": self.ewma_wait,
+        }
+
+
+class MeteredTransport(httpx.AsyncHTTPTransport):
+    """HTTP transport that records how long requests wait for a connection.
+
+    The wait ends at the first connection level trace event of a request,
+    which is either opening a new connection or sending on a pooled one.
+    The wait and the time taken to connect are also added to the timings of
+    the request being handled, if any.
+    """
+
+    def __init__(self, stats: PoolStats, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = self.stats
+        timings = request_timings.get()
+        if timings is not None:
+            # Only keep the timings of the last attempt
+            for key in ("pool_wait", "connect_start", "connect"):
+                timings.pop(key, None)
+        start = perf_counter()
+        waiting = True
+
+        async def trace(event: str, info: dict):
+            nonlocal waiting
+            if waiting:
+                waiting = False
+                stats.waiting -= 1
+                stats.record_wait(perf_counter() - start)
+                if timings is not None:
+                    timings["pool_wait"] = perf_counter() - start
+            if timings is None:
+                return
+            if event == "connection.connect_tcp.started":
+                timings["connect_start"] = perf_counter()
+            elif (
+                event
+                in (
+                    "connection.connect_tcp.complete",
+                    "connection.start_tls.complete",
+                )
+                and "connect_start" in timings
+            ):
+                timings["connect"] = perf_counter() - timings["connect_start"]
+
+        stats.waiting += 1
+        request.extensions["trace"] = trace
+        try:
+            return await super().handle_async_request(request)
+        except httpx.PoolTimeout:
+            stats.pool_timeouts += 1
+            raise
+        finally:
+            if waiting:
+                waiting = False
+                stats.waiting -= 1
+
+
+def client_options(defaults: dict, overrides: dict | None = None) -> dict:
+    options = dict(defaults)
+    for key, value in (overrides or {}).items():
+        if key not in HTTP_OPTIONS:
+            raise ValueError(f"Unknown HTTP option {key}")
+        options[key] = value
+    return options
+
+
+def build_client(options: dict) -> tuple[httpx.AsyncClient, PoolStats]:
+    """Build a client with its own connection pool and the stats of the pool."""
+    stats = PoolStats()
+    transport = MeteredTransport(
+        stats,
+        limits=httpx.Limits(
+            max_connections=options["max_connections"],
+            max_keepalive_connections=options["max_keepalive_connections"],
+            keepalive_expiry=options["keepalive_expiry"],
+        ),
+        http2=options["http2"],
+    )
+    timeout = httpx.Timeout(
+        connect=options["connect_timeout"],
+        read=options["read_timeout"],
+        write=options["write_timeout"],
+        pool=options["pool_timeout"],
+    )
+    return httpx.AsyncClient(transport=transport, timeout=timeout), stats
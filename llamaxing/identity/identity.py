@@ -6,12 +6,21 @@ class ObservabilityConfig(BaseModel):
     langfuse_secret_key: SecretStr | None = None
 
 
+class RateLimitConfig(BaseModel):
+    requests_per_second: float | None = None
+    burst: int | None = None
+    tokens_per_minute: int | None = None
+
+
 class Identity(BaseModel):
     id: str
     auth_key: SecretStr | None = None
     name: str | None = None
     info: dict | None = None
+    admin: bool = False
     observability: ObservabilityConfig | None = None
+    rate_limits: RateLimitConfig | None = None
+    response_cache: bool = True
 
     @model_serializer()
     def serialize_model(self):
@@ -11,3 +11,7 @@ class IdentityStoreInterface(ABC):
     @abstractmethod
     def find_identity(self, key) -> Identity:
         pass
+
+    @abstractmethod
+    def reload(self):
+        pass
@@ -1,17 +1,41 @@
+import hashlib
+import hmac
 import json
 
 from identity.identity import Identity
 from identity.store.interface import IdentityStoreInterface
+from logging_utils import logger
 from settings import settings
 
 
+def key_digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
+
+
 class IdentityStore(IdentityStoreInterface):
     def __init__(self) -> None:
+        self.reload()
+
+    def reload(self):
         with open(settings.identity_store_json_filename) as f:
-            self.identities = json.load(f)
+            identities = json.load(f)
+        index = {}
+        for item in identities:
+            identity = Identity.model_validate(item)
+            if identity.auth_key is None:
+                continue
+            digest = key_digest(identity.auth_key.get_secret_value())
+            if digest in index:
+                logger.warning(f"Duplicate auth key for identity {identity.id}")
+                continue
+            index[digest] = identity
+        # Swap in the new index only once it has been fully built
+        self.identities = index
 
     def find_identity(self, key) -> Identity:
-        id = next((id for id in self.identities if id["auth_key"] == key), None)
-        if id is not None:
-            return Identity.model_validate(id)
+        identity = self.identities.get(key_digest(key))
+        if identity is not None and hmac.compare_digest(
+            identity.auth_key.get_secret_value().encode(), key.encode()
+        ):
+            return identity
         return None
@@ -6,6 +6,9 @@ class IdentityStore(IdentityStoreInterface):
     def __init__(self) -> None:
         pass
 
+    def reload(self):
+        pass
+
     def find_identity(self, key) -> Identity:
         raise Exception(
             "App is configured to not use an identity store. "
@@ -0,0 +1,55 @@
+import json
+from collections.abc import Callable
+from typing import Any
+
+from logging_utils import logger
+from settings import settings
+from starlette.responses import JSONResponse
+
+BACKENDS = ("orjson", "msgspec", "stdlib")
+
+
+def _stdlib() -> tuple[Callable, Callable]:
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(
+            obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode()
+
+    return json.loads, dumps
+
+
+def _orjson() -> tuple[Callable, Callable]:
+    import orjson
+
+    return orjson.loads, orjson.dumps
+
+
+def _msgspec() -> tuple[Callable, Callable]:
+    import msgspec
+
+    return msgspec.json.Decoder().decode, msgspec.json.Encoder().encode
+
+
+def load_backend(name: str) -> tuple[str, Callable, Callable]:
+    """Return (name, loads, dumps) for a backend, or the first available for auto"""
+    if name == "auto":
+        for candidate in BACKENDS:
+            try:
+                return load_backend(candidate)
+            except ImportError:
+                continue
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown JSON codec: {name}")
+    loads, dumps = {"orjson": _orjson, "msgspec": _msgspec, "stdlib": _stdlib}[name]()
+    return name, loads, dumps
+
+
+# All backends raise a ValueError subclass on invalid input. loads accepts
+# bytes or str, dumps returns bytes.
+backend, loads, dumps = load_backend(settings.app_json_codec)
+logger.info(f"Using {backend} JSON codec")
+
+
+class CodecJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1 @@
+from .interface import LoadBalancerInterface  # noqa: F401
@@ -0,0 +1,12 @@
+from llm.balancing import LoadBalancerInterface
+from llm.instance import InstanceRecord
+
+
+class LoadBalancer(LoadBalancerInterface):
+    """Pick the instance with the lowest EWMA latency weighted by its load."""
+
+    def __init__(self) -> None:
+        pass
+
+    def select(self, instances: list[InstanceRecord]) -> InstanceRecord:
+        return min(instances, key=lambda x: x.stats.load_score())
@@ -0,0 +1,13 @@
+from abc import ABC, abstractmethod
+
+from llm.instance import InstanceRecord
+
+
+class LoadBalancerInterface(ABC):
+    @abstractmethod
+    def __init__(self) -> None:
+        pass
+
+    @abstractmethod
+    def select(self, instances: list[InstanceRecord]) -> InstanceRecord:
+        pass
@@ -0,0 +1,15 @@
+import random
+
+from llm.balancing import LoadBalancerInterface
+from llm.instance import InstanceRecord
+
+
+class LoadBalancer(LoadBalancerInterface):
+    """Pick the instance with the fewest outstanding requests."""
+
+    def __init__(self) -> None:
+        pass
+
+    def select(self, instances: list[InstanceRecord]) -> InstanceRecord:
+        least = min(x.stats.in_flight for x in instances)
+        return random.choice([x for x in instances if x.stats.in_flight == least])
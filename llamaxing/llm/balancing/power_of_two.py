@@ -0,0 +1,19 @@
+import random
+
+from llm.balancing import LoadBalancerInterface
+from llm.instance import InstanceRecord
+
+
+class LoadBalancer(LoadBalancerInterface):
+    """Power of two choices: sample two instances and keep the less loaded one."""
+
+    def __init__(self) -> None:
+        pass
+
+    def select(self, instances: list[InstanceRecord]) -> InstanceRecord:
+        if len(instances) == 1:
+            return instances[0]
+        a, b = random.sample(instances, 2)
+        if b.stats.load_score() < a.stats.load_score():
+            return b
+        return a
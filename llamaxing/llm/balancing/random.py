@@ -0,0 +1,12 @@
+import random
+
+from llm.balancing import LoadBalancerInterface
+from llm.instance import InstanceRecord
+
+
+class LoadBalancer(LoadBalancerInterface):
+    def __init__(self) -> None:
+        pass
+
+    def select(self, instances: list[InstanceRecord]) -> InstanceRecord:
+        return random.choice(instances)
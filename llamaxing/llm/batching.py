@@ -0,0 +1,158 @@
+import asyncio
+
+import json_codec
+from httpx import AsyncClient, Response
+from logging_utils import log_exception
+from settings import settings
+
+# Response headers that describe the combined upstream body rather than a slice
+HOP_HEADERS = ("content-length", "content-encoding", "transfer-encoding")
+
+
+def normalize_input(inputs) -> list:
+    if isinstance(inputs, list) and len(inputs) > 0 and isinstance(inputs[0], int):
+        # A single token array
+        return [inputs]
+    return inputs if isinstance(inputs, list) else [inputs]
+
+
+def apportion(total: int, weights: list[int]) -> list[int]:
+    """Split total in proportion to weights so that the shares add up to it."""
+    weight = sum(weights) or 1
+    shares = [total * x // weight for x in weights]
+    remainders = sorted(
+        range(len(weights)), key=lambda i: total * weights[i] % weight, reverse=True
+    )
+    for i in remainders[: total - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def estimate_tokens(item) -> int:
+    # A rough estimate is enough to bound the size of a batch
+    return len(item) if isinstance(item, list) else len(item) // 4 + 1
+
+
+class Batch:
+    def __init__(
+        self, params: dict, url: str, headers: dict, requests_client: AsyncClient
+    ):
+        self.params = params
+        self.url = url
+        self.headers = headers
+        self.requests_client = requests_client
+        self.entries: list[tuple[list, asyncio.Future]] = []
+        self.size = 0
+        self.tokens = 0
+
+
+class EmbeddingBatcher:
+    """Combines concurrent embeddings requests to an instance into one call.
+
+    Requests with the same parameters (apart from the input) are collected for
+    up to llm_embedding_batch_window seconds, or until the batch reaches
+    llm_embedding_batch_max_size inputs or llm_embedding_batch_max_tokens
+    estimated tokens. Each caller gets a response with its own slice of the
+    embeddings and a share of the usage proportional to its input length.
+    """
+
+    def __init__(self) -> None:
+        self.batches: dict[bytes, Batch] = {}
+        self.pending = set()
+
+    async def submit(
+        self, data: dict, url: str, headers: dict, requests_client: AsyncClient
+    ) -> Response:
+        inputs = normalize_input(data.get("input"))
+        tokens = sum(estimate_tokens(x) for x in inputs)
+        if (
+            len(inputs) >= settings.llm_embedding_batch_max_size
+            or tokens >= settings.llm_embedding_batch_max_tokens
+        ):
+            return await requests_client.post(
+                url, content=json_codec.dumps(data), headers=headers
+            )
+
+        params = {k: v for k, v in data.items() if k != "input"}
+        key = url.encode() + json_codec.dumps(params)
+        batch = self.batches.get(key)
+        if batch is not None and (
+            batch.size + len(inputs) > settings.llm_embedding_batch_max_size
+            or batch.tokens + tokens > settings.llm_embedding_batch_max_tokens
+        ):
+            self.start_flush(key, batch)
+            batch = None
+        if batch is None:
+            batch = self.batches[key] = Batch(params, url, headers, requests_client)
+            asyncio.get_running_loop().call_later(
+                settings.llm_embedding_batch_window, self.start_flush, key, batch
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        batch.entries.append((inputs, future))
+        batch.size += len(inputs)
+        batch.tokens += tokens
+        if batch.size >= settings.llm_embedding_batch_max_size:
+            self.start_flush(key, batch)
+        return await future
+
+    def start_flush(self, key: bytes, batch: Batch):
+        if self.batches.get(key) is not batch:
+            # Already flushed
+            return
+        del self.batches[key]
+        task = asyncio.create_task(self.flush(batch))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def flush(self, batch: Batch):
+        entries = [x for x in batch.entries if not x[1].done()]
+        if len(entries) == 0:
+            return
+        combined = [item for inputs, _ in entries for item in inputs]
+        try:
+            r = await batch.requests_client.post(
+                batch.url,
+                content=json_codec.dumps({**batch.params, "input": combined}),
+                headers=batch.headers,
+            )
+            responses = self.split_response(r, entries)
+        except Exception as e:
+            log_exception()
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), response in zip(entries, responses, strict=True):
+            if not future.done():
+                future.set_result(response)
+
+    @staticmethod
+    def split_response(r: Response, entries: list) -> list[Response]:
+        headers = [(k, v) for k, v in r.headers.items() if k not in HOP_HEADERS]
+        if r.status_code != 200:
+            return [
+                Response(r.status_code, headers=headers, content=r.content)
+                for _ in entries
+            ]
+        response = json_codec.loads(r.content)
+        embeddings = sorted(response["data"], key=lambda x: x["index"])
+        usage = response.get("usage") or {}
+        lengths = [sum(len(x) for x in inputs) for inputs, _ in entries]
+        shares = {
+            k: apportion(v, lengths) for k, v in usage.items() if isinstance(v, int)
+        }
+        responses = []
+        offset = 0
+        for n, (inputs, _) in enumerate(entries):
+            data = embeddings[offset : offset + len(inputs)]
+            offset += len(inputs)
+            body = {
+                **response,
+                "data": [{**x, "index": i} for i, x in enumerate(data)],
+                "usage": {k: v[n] for k, v in shares.items()},
+            }
+            responses.append(
+                Response(200, headers=headers, content=json_codec.dumps(body))
+            )
+        return responses
@@ -0,0 +1,76 @@
+from time import monotonic
+
+from settings import settings
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self) -> None:
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN:
+            if self.open_for() > 0:
+                return False
+            self.state = self.HALF_OPEN
+            self.probes_in_flight = 0
+            self.probe_successes = 0
+        if self.state == self.HALF_OPEN:
+            return self.probes_in_flight < settings.llm_circuit_breaker_probes
+        return True
+
+    def open_for(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(
+            0.0, self.opened_at + settings.llm_circuit_breaker_cooldown - monotonic()
+        )
+
+    def on_request_start(self) -> bool:
+        """Register a request, returning True if it acts as a half-open probe."""
+        if self.state == self.HALF_OPEN:
+            self.probes_in_flight += 1
+            return True
+        return False
+
+    def on_request_end(self, success: bool, probe: bool):
+        if probe and self.state == self.HALF_OPEN:
+            self.probes_in_flight -= 1
+        if success:
+            self.consecutive_failures = 0
+            if probe and self.state == self.HALF_OPEN:
+                self.probe_successes += 1
+                if self.probe_successes >= settings.llm_circuit_breaker_probes:
+                    self.state = self.CLOSED
+            return
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED
+            and self.consecutive_failures >= settings.llm_circuit_breaker_threshold
+        ):
+            self.trip()
+
+    def release(self, probe: bool):
+        """End a request without counting it as a success or a failure."""
+        if probe and self.state == self.HALF_OPEN:
+            self.probes_in_flight -= 1
+
+    def trip(self):
+        self.state = self.OPEN
+        self.opened_at = monotonic()
+        self.probes_in_flight = 0
+        self.probe_successes = 0
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_for": self.open_for(),
+        }
@@ -0,0 +1 @@
+from .interface import ResponseCacheInterface  # noqa: F401
@@ -0,0 +1,111 @@
+import base64
+import hashlib
+import json
+from array import array
+from collections.abc import Awaitable, Callable
+
+import json_codec
+from llm.cache import ResponseCacheInterface
+from starlette.responses import Response
+
+
+def item_key(model: str, dimensions: int | None, item) -> str:
+    canonical = json.dumps([model, dimensions, item], ensure_ascii=False)
+    return "embedding:" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def encode_vector(embedding: list[float] | str) -> bytes:
+    """Pack an embedding as little-endian float32, the layout of base64 output."""
+    if isinstance(embedding, str):
+        return base64.b64decode(embedding)
+    vector = array("f", embedding)
+    if vector.itemsize != 4:
+        raise ValueError("float32 arrays are not supported on this platform")
+    return vector.tobytes()
+
+
+def decode_vector(raw: bytes, encoding_format: str) -> list[float] | str:
+    if encoding_format == "base64":
+        return base64.b64encode(raw).decode()
+    return array("f", raw).tolist()
+
+
+async def cached_embeddings(
+    data: dict,
+    model: str,
+    cache: ResponseCacheInterface,
+    forward: Callable[[dict], Awaitable[Response]],
+) -> Response:
+    """Serve the inputs of an embeddings request from the cache where possible.
+
+    Only the distinct inputs that miss are sent upstream, as a single smaller
+    batch, and the response is reassembled in the original order. The usage reported is
+    that of the upstream request, i.e. of the misses.
+    """
+    inputs = data.get("input")
+    if isinstance(inputs, list) and (
+        len(inputs) == 0 or isinstance(inputs[0], (str, list))
+    ):
+        items = inputs
+    else:
+        # A single string or token array
+        items = [inputs]
+    if len(items) == 0:
+        return await forward(data)
+    dimensions = data.get("dimensions")
+    keys = [item_key(model, dimensions, x) for x in items]
+    vectors = await cache.get_many(keys)
+    misses = [i for i, x in enumerate(vectors) if x is None]
+
+    response_model = data["model"]
+    usage = {"prompt_tokens": 0, "total_tokens": 0}
+    background = None
+    if misses:
+        # Repeated inputs are only sent once
+        first_misses = {}
+        for i in misses:
+            first_misses.setdefault(keys[i], i)
+        forwarded = list(first_misses.values())
+        response = await forward({**data, "input": [items[i] for i in forwarded]})
+        if response.status_code != 200:
+            return response
+        upstream = json_codec.loads(response.body)
+        response_model = upstream.get("model", response_model)
+        usage = upstream.get("usage") or usage
+        background = response.background
+        fresh = {}
+        for position, x in enumerate(upstream["data"]):
+            i = forwarded[x.get("index", position)]
+            fresh[keys[i]] = encode_vector(x["embedding"])
+        if len(fresh) != len(forwarded):
+            raise ValueError("Upstream returned a different number of embeddings")
+        for i in misses:
+            vectors[i] = fresh[keys[i]]
+        await cache.set_many(fresh)
+
+    encoding_format = data.get("encoding_format") or "float"
+    body = {
+        "object": "list",
+        "data": [
+            {
+                "object": "embedding",
+                "index": i,
+                "embedding": decode_vector(x, encoding_format),
+            }
+            for i, x in enumerate(vectors)
+        ],
+        "model": response_model,
+        "usage": usage,
+    }
+    if not misses:
+        cache_status = "HIT"
+    elif len(misses) < len(items):
+        cache_status = "PARTIAL"
+    else:
+        cache_status = "MISS"
+    return Response(
+        json_codec.dumps(body),
+        media_type="application/json",
+        headers={"X-Cache": cache_status},
+        background=background,
+    )
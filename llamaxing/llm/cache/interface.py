@@ -0,0 +1,43 @@
+import hashlib
+import json
+from abc import ABC, abstractmethod
+
+# Fields that don't change the response content and are left out of the key
+IGNORED_FIELDS = ("model", "stream", "stream_options", "observation_metadata")
+
+
+def cache_key(endpoint: str, model: str, data: dict) -> str:
+    """Hash of the endpoint, resolved model ID and the normalized request body."""
+    normalized = {k: v for k, v in data.items() if k not in IGNORED_FIELDS}
+    canonical = json.dumps(
+        [endpoint, model, normalized],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCacheInterface(ABC):
+    @abstractmethod
+    def __init__(self) -> None:
+        pass
+
+    @abstractmethod
+    async def on_shutdown(self):
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes):
+        pass
+
+    async def get_many(self, keys: list[str]) -> list[bytes | None]:
+        return [await self.get(key) for key in keys]
+
+    async def set_many(self, items: dict[str, bytes]):
+        for key, value in items.items():
+            await self.set(key, value)
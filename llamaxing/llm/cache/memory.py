@@ -0,0 +1,56 @@
+from collections import OrderedDict
+from time import monotonic
+
+from llm.cache import ResponseCacheInterface
+from settings import settings
+
+
+class ResponseCache(ResponseCacheInterface):
+    """LRU cache with a TTL kept in process memory, i.e. per worker."""
+
+    def __init__(
+        self,
+        ttl: float | None = None,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+    ) -> None:
+        self.ttl = settings.response_cache_ttl if ttl is None else ttl
+        self.max_entries = (
+            settings.response_cache_memory_max_entries
+            if max_entries is None
+            else max_entries
+        )
+        self.max_bytes = (
+            settings.response_cache_memory_max_bytes if max_bytes is None else max_bytes
+        )
+        self.entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.size = 0
+
+    async def on_shutdown(self):
+        self.entries.clear()
+        self.size = 0
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < monotonic():
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (monotonic() + self.ttl, value)
+        self.size += len(value)
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: str):
+        _, value = self.entries.pop(key)
+        self.size -= len(value)
@@ -0,0 +1,15 @@
+from llm.cache import ResponseCacheInterface
+
+
+class ResponseCache(ResponseCacheInterface):
+    def __init__(self) -> None:
+        pass
+
+    async def on_shutdown(self):
+        pass
+
+    async def get(self, key: str) -> bytes | None:
+        return None
+
+    async def set(self, key: str, value: bytes):
+        pass
@@ -0,0 +1,55 @@
+import redis.asyncio as redis
+from llm.cache import ResponseCacheInterface
+from logging_utils import log_exception
+from settings import settings
+
+
+class ResponseCache(ResponseCacheInterface):
+    """Cache shared by all workers through Redis, which handles the eviction."""
+
+    def __init__(self, client: redis.Redis | None = None) -> None:
+        if client is None:
+            client = redis.from_url(settings.response_cache_redis_url)
+        self.client = client
+
+    async def on_shutdown(self):
+        await self.client.aclose()
+
+    async def get(self, key: str) -> bytes | None:
+        try:
+            return await self.client.get(
+                f"{settings.response_cache_redis_prefix}:{key}"
+            )
+        except Exception:
+            # Treat an unavailable cache as a miss
+            log_exception()
+            return None
+
+    async def get_many(self, keys: list[str]) -> list[bytes | None]:
+        prefix = settings.response_cache_redis_prefix
+        try:
+            return await self.client.mget([f"{prefix}:{key}" for key in keys])
+        except Exception:
+            log_exception()
+            return [None] * len(keys)
+
+    async def set_many(self, items: dict[str, bytes]):
+        prefix = settings.response_cache_redis_prefix
+        ttl = int(settings.response_cache_ttl * 1000)
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for key, value in items.items():
+                    pipe.set(f"{prefix}:{key}", value, px=ttl)
+                await pipe.execute()
+        except Exception:
+            log_exception()
+
+    async def set(self, key: str, value: bytes):
+        try:
+            await self.client.set(
+                f"{settings.response_cache_redis_prefix}:{key}",
+                value,
+                px=int(settings.response_cache_ttl * 1000),
+            )
+        except Exception:
+            log_exception()
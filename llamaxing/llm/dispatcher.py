@@ -1,65 +1,125 @@
+import asyncio
 import json
-import os
+import math
 import random
-from importlib import import_module
+from functools import partial
+from time import monotonic
 
+import json_codec
+import timings
 from fastapi import HTTPException
-from httpx import AsyncClient
+from http_client import PoolStats
+from httpx import AsyncClient, PoolTimeout, TransportError
 from identity import Identity
+from llm.cache import ResponseCacheInterface
+from llm.cache.embeddings import cached_embeddings
+from llm.cache.interface import cache_key
+from llm.instance import InstanceRecord, RetryableUpstreamError
 from llm.logging import LoggingClientInterface
+from llm.routing import ModelRecord, apply_quotas, compile_routing_table
+from llm.utils.body import decode_body
+from llm.utils.broadcast import StreamBroadcast
+from llm.utils.openai import num_tokens_from_request, warm_up
+from llm.utils.responses import LoggingStreamingResponse
+from llm.utils.sse import StreamAccumulator, replay_stream
+from llm.wrappers import cache_hit_response
+from logging_utils import log_exception, logger
 from observability import ObservabilityClientInterface
+from ratelimit import RateLimiterInterface
 from settings import settings
+from starlette.responses import Response, StreamingResponse
+
+
+def is_deterministic(endpoint: str, data: dict) -> bool:
+    if endpoint == "embeddings":
+        return True
+    if endpoint in ("chat_completions", "completions"):
+        return data.get("temperature") == 0 and (data.get("n") or 1) == 1
+    return False
+
+
+async def filter_stream(content, accumulator: StreamAccumulator):
+    async for chunk in content:
+        chunk = accumulator.feed(chunk)
+        if chunk:
+            yield chunk
+    chunk = accumulator.flush()
+    if chunk:
+        yield chunk
 
 
 class LLMDispatcher:
     def __init__(self) -> None:
+        self.pending = set()
+        self.flights: dict[tuple, asyncio.Future] = {}
+        self.clients: dict[tuple, tuple[AsyncClient, PoolStats]] = {}
         self.load_models()
 
+    async def on_shutdown(self):
+        if len(self.pending) > 0:
+            await asyncio.wait(self.pending, timeout=5)
+        for client, _ in self.clients.values():
+            await client.aclose()
+
     def load_models(self):
+        self.models, self.instances, self.models_response = self.build_models()
+        apply_quotas(self.instances.values())
+
+    async def reload_models(self):
+        # Build the new tables off the event loop and swap them in at once.
+        # Requests already dispatched keep their references to the old ones.
+        self.models, self.instances, self.models_response = await asyncio.to_thread(
+            self.build_models
+        )
+        apply_quotas(self.instances.values())
+        logger.info("Reloaded models")
+        await asyncio.to_thread(self.warm_up_tokenizers)
+
+    def warm_up_tokenizers(self):
+        warm_up({model.id for model in self.models.values()})
+
+    def build_models(self):
         with open("models.json") as f:
             models = json.load(f)
-        model_list = []
-        for m in models:
-            item = m.copy()
-            aliases = item.pop("aliases")
-            for instance in item["instances"]:
-                if "azure_api_key" in instance:
-                    instance["azure_api_key"] = os.path.expandvars(
-                        instance["azure_api_key"]
-                    )
-                if "azure_endpoint" in instance:
-                    instance["azure_endpoint"] = os.path.expandvars(
-                        instance["azure_endpoint"]
-                    )
-                if "openai_api_key" in instance:
-                    instance["openai_api_key"] = os.path.expandvars(
-                        instance["openai_api_key"]
-                    )
-            model_list.append(item)
-            if len(aliases) > 0:
-                for a in aliases:
-                    alias = item.copy()
-                    alias["id"] = a
-                    model_list.append(alias)
-        self.models = model_list
+        previous = getattr(self, "instances", {})
+        table = compile_routing_table(
+            models, {id: x.stats for id, x in previous.items()}, self.clients
+        )
+        instances = {x.id: x for model in table.values() for x in model.instances}
+        models_response = {
+            "data": [
+                {
+                    "id": id,
+                    "capabilities": m["capabilities"],
+                    "object": "model",
+                    "proxied_by": settings.app_name,
+                }
+                for m in models
+                for id in [m["id"], *m.get("aliases", [])]
+            ],
+            "object": "list",
+        }
+        return table, instances, models_response
 
     def get_models(self):
+        return self.models_response
+
+    def get_instances(self):
         return {
             "data": [
                 {
-                    "id": x["id"],
-                    "capabilities": x["capabilities"],
-                    "object": "model",
-                    "proxied_by": settings.app_name,
+                    **x.stats.to_dict(),
+                    "http_pool": None
+                    if x.pool_stats is None
+                    else x.pool_stats.to_dict(),
                 }
-                for x in self.models
+                for x in self.instances.values()
             ],
             "object": "list",
         }
 
     def get_model(self, id):
-        m = next((model for model in self.models if model["id"] == id), None)
-        return m
+        return self.models.get(id)
 
     async def call(
         self,
@@ -69,6 +129,8 @@ class LLMDispatcher:
         requests_client: AsyncClient,
         logging_client: LoggingClientInterface = None,
         observability_client: ObservabilityClientInterface = None,
+        rate_limiter: RateLimiterInterface = None,
+        response_cache: ResponseCacheInterface = None,
     ):
         if "model" not in data:
             raise HTTPException(400, "No model specified in request")
@@ -77,22 +139,280 @@ class LLMDispatcher:
         if model is None:
             raise HTTPException(404, detail="Model not found")
 
-        if endpoint not in model["capabilities"]:
+        if endpoint not in model.capabilities:
             raise HTTPException(405, detail="Model not valid for this endpoint")
 
-        # Naive load balancing
-        model_instance = random.choice(model["instances"])
+        dispatch = partial(
+            self.dispatch,
+            endpoint,
+            model,
+            identity=identity,
+            requests_client=requests_client,
+            logging_client=logging_client,
+            observability_client=observability_client,
+            rate_limiter=rate_limiter,
+        )
+        if settings.llm_coalesce_requests:
+            dispatch = partial(self.coalesce, endpoint, model, identity, dispatch)
+        if response_cache is not None:
+            log_hit = partial(
+                cache_hit_response,
+                endpoint=endpoint,
+                data=data,
+                identity=identity,
+                logging_client=logging_client,
+                observability_client=observability_client,
+            )
+            if endpoint == "embeddings" and settings.embedding_cache:
+                response = await cached_embeddings(
+                    decode_body(data), model.id, response_cache, dispatch
+                )
+                if response.headers.get("X-Cache") == "HIT":
+                    return log_hit(response, response.body)
+                return response
+            if endpoint in settings.response_cache_endpoints and (
+                settings.response_cache_non_deterministic
+                or is_deterministic(endpoint, data)
+            ):
+                key = cache_key(endpoint, model.id, decode_body(data))
+                cached = await response_cache.get(key)
+                if cached is not None:
+                    return log_hit(self.cached_response(cached, data), cached)
+                return await dispatch(
+                    data,
+                    response_callback=partial(self.store_response, response_cache, key),
+                )
+        return await dispatch(data)
 
-        llm_provider_module = import_module(
-            f"llm.provider.{model_instance['provider']}"
+    async def dispatch(
+        self,
+        endpoint: str,
+        model: ModelRecord,
+        data: dict,
+        identity: Identity,
+        requests_client: AsyncClient,
+        logging_client: LoggingClientInterface = None,
+        observability_client: ObservabilityClientInterface = None,
+        rate_limiter: RateLimiterInterface = None,
+        response_callback=None,
+    ):
+        timings.mark("dispatch")
+        tokens = 0
+        if model.token_limited:
+            try:
+                tokens = await num_tokens_from_request(endpoint, data, model.id)
+            except Exception:
+                log_exception()
+
+        usage_callback = None
+        if rate_limiter is not None:
+            usage_callback = partial(rate_limiter.consume_tokens, identity)
+
+        deadline = monotonic() + settings.llm_retry_deadline
+        tried = set()
+        attempt = 0
+        while True:
+            attempt += 1
+            model_instance = self.select_instance(model, tried, tokens)
+            tried.add(model_instance.id)
+
+            method = model_instance.endpoints[endpoint]
+            tracker = model_instance.stats.start_request(
+                retryable=attempt < settings.llm_retry_max_attempts
+                and monotonic() < deadline,
+                tokens=tokens,
+                usage_callback=usage_callback,
+                response_callback=response_callback,
+            )
+            try:
+                return await method(
+                    data,
+                    identity,
+                    model_instance.requests_client or requests_client,
+                    model_instance,
+                    logging_client,
+                    observability_client,
+                    tracker,
+                )
+            except PoolTimeout:
+                # Our own connection pool is full, the instance may be healthy
+                tracker.finish(counted=False)
+                raise HTTPException(
+                    503, detail="Upstream connection pool exhausted"
+                ) from None
+            except (RetryableUpstreamError, TransportError) as e:
+                tracker.finish(error=True)
+                logger.warning(
+                    f"Attempt {attempt} on instance {model_instance.id} failed: {e!r}"
+                )
+                delay = self.retry_delay(model, tried, attempt)
+                if (
+                    attempt >= settings.llm_retry_max_attempts
+                    or monotonic() + delay >= deadline
+                ):
+                    if isinstance(e, RetryableUpstreamError):
+                        headers = None
+                        if e.retry_after is not None:
+                            headers = {"Retry-After": str(math.ceil(e.retry_after))}
+                        raise HTTPException(
+                            e.status_code,
+                            detail="Upstream request failed",
+                            headers=headers,
+                        ) from None
+                    raise
+                await asyncio.sleep(delay)
+            except Exception:
+                tracker.finish(error=True)
+                raise
+
+    async def coalesce(
+        self,
+        endpoint: str,
+        model: ModelRecord,
+        identity: Identity,
+        dispatch,
+        data: dict,
+        **kwargs,
+    ):
+        """Share one upstream call between concurrent identical requests.
+
+        Only requests from the same identity are shared. The followers get a
+        copy of the leader's response and are not logged, observed or
+        charged against the identity's token rate limit themselves.
+        """
+        if not is_deterministic(endpoint, data):
+            return await dispatch(data, **kwargs)
+        stream = data.get("stream") is True
+        key = (
+            identity.id,
+            cache_key(endpoint, model.id, decode_body(data)),
+            stream,
+            json_codec.dumps(data.get("stream_options")) if stream else None,
         )
-        llm_provider = llm_provider_module.LLMProvider
-        method = getattr(llm_provider, endpoint)
-        return await method(
-            data,
-            identity,
-            requests_client,
-            model_instance,
-            logging_client,
-            observability_client,
+        flight = self.flights.get(key)
+        if flight is not None:
+            try:
+                return self.join_flight(await asyncio.shield(flight))
+            except asyncio.CancelledError:
+                if flight.cancelled():
+                    # The leading request went away, make our own call instead
+                    return await dispatch(data, **kwargs)
+                raise
+
+        flight = self.flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await dispatch(data, **kwargs)
+        except asyncio.CancelledError:
+            self.flights.pop(key, None)
+            flight.cancel()
+            raise
+        except Exception as e:
+            self.flights.pop(key, None)
+            flight.set_exception(e)
+            # Mark the exception as retrieved in case nobody joined
+            flight.exception()
+            raise
+
+        if isinstance(response, LoggingStreamingResponse):
+            broadcast = StreamBroadcast(
+                response.body_iterator,
+                background=response.background,
+                on_done=partial(self.flights.pop, key, None),
+            )
+            # The broadcast closes the upstream response once it has been read
+            response.background = None
+            response.body_iterator = broadcast.subscribe()
+            flight.set_result((response, broadcast))
+        else:
+            self.flights.pop(key, None)
+            flight.set_result((response, None))
+        return response
+
+    @staticmethod
+    def join_flight(result: tuple) -> Response:
+        response, broadcast = result
+        headers = {"X-Coalesced": "true"}
+        if broadcast is not None:
+            content = broadcast.subscribe()
+            accumulator = response.accumulator
+            if accumulator is not None and accumulator.drop_usage_chunk:
+                # Strip the usage chunk the leader asked for on our behalf too
+                content = filter_stream(
+                    content, StreamAccumulator(accumulator.object_type, True)
+                )
+            follower = StreamingResponse(content, status_code=response.status_code)
+            follower.raw_headers = [
+                x for x in response.raw_headers if x[0] != b"content-length"
+            ]
+            follower.headers.update(headers)
+            return follower
+        follower = Response(response.body, status_code=response.status_code)
+        follower.raw_headers = list(response.raw_headers)
+        follower.headers.update(headers)
+        return follower
+
+    def select_instance(
+        self, model: ModelRecord, tried: set, tokens: int = 0
+    ) -> InstanceRecord:
+        healthy = [x for x in model.instances if x.stats.breaker.allow_request()]
+        if len(healthy) == 0:
+            open_for = min(x.stats.breaker.open_for() for x in model.instances)
+            raise HTTPException(
+                503,
+                detail="No healthy model instances available",
+                headers={"Retry-After": str(math.ceil(open_for))},
+            )
+        # Prefer instances we haven't tried yet that aren't being rate limited
+        # and have enough of their TPM/RPM budget left for this request
+        candidates = [x for x in healthy if x.id not in tried]
+        if len(candidates) == 0:
+            candidates = healthy
+        available = [
+            x
+            for x in candidates
+            if not x.stats.is_throttled() and x.stats.quota.has_capacity(tokens)
+        ]
+        if len(available) == 0:
+            available = candidates
+        return model.load_balancer.select(available)
+
+    def retry_delay(self, model: ModelRecord, tried: set, attempt: int) -> float:
+        backoff = min(
+            settings.llm_retry_backoff_max,
+            settings.llm_retry_backoff_base * 2 ** (attempt - 1),
         )
+        delay = random.uniform(0, backoff)
+        # Only wait out Retry-After if every remaining candidate is throttled
+        candidates = [x for x in model.instances if x.id not in tried]
+        if len(candidates) == 0:
+            candidates = model.instances
+        throttled_for = min(x.stats.throttled_for() for x in candidates)
+        return max(delay, throttled_for)
+
+    @staticmethod
+    def cached_response(cached: bytes, data: dict) -> Response:
+        headers = {"X-Cache": "HIT"}
+        if data.get("stream") is True:
+            include_usage = (data.get("stream_options") or {}).get("include_usage")
+            return Response(
+                replay_stream(json_codec.loads(cached), include_usage),
+                media_type="text/event-stream",
+                headers=headers,
+            )
+        return Response(cached, media_type="application/json", headers=headers)
+
+    def store_response(self, response_cache: ResponseCacheInterface, key, response):
+        if response.get("streaming_response"):
+            if not response.get("stream_merge_successful"):
+                return
+            # Store merged streams in the shape of a non-streaming response
+            response = {
+                k: v
+                for k, v in response.items()
+                if k not in ("streaming_response", "stream_merge_successful")
+            }
+            if response.get("object") == "chat.completion.chunk":
+                response["object"] = "chat.completion"
+        task = asyncio.create_task(response_cache.set(key, json_codec.dumps(response)))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
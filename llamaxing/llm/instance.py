@@ -0,0 +1,192 @@
+import math
+import typing
+from dataclasses import dataclass
+from time import monotonic, perf_counter
+
+from http_client import PoolStats
+from httpx import AsyncClient, Headers, Response
+from llm.batching import EmbeddingBatcher
+from llm.breaker import CircuitBreaker
+from llm.quota import InstanceQuota
+from llm.utils.headers import parse_ratelimit_exhausted, parse_retry_after
+from settings import settings
+
+
+class RetryableUpstreamError(Exception):
+    def __init__(self, status_code: int, retry_after: float | None = None) -> None:
+        super().__init__(f"Upstream returned status code {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class InstanceStats:
+    def __init__(
+        self, instance_id: str, tpm: int | None = None, rpm: int | None = None
+    ) -> None:
+        self.instance_id = instance_id
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.ewma_ttfb: float | None = None
+        self.throttled_until = 0.0
+        self.breaker = CircuitBreaker()
+        self.quota = InstanceQuota(tpm, rpm)
+
+    def start_request(
+        self,
+        retryable: bool = False,
+        tokens: int = 0,
+        usage_callback: typing.Callable[[int], None] | None = None,
+        response_callback: typing.Callable[[dict], None] | None = None,
+    ) -> "RequestTracker":
+        return RequestTracker(
+            self, retryable, tokens, usage_callback, response_callback
+        )
+
+    def record_ttfb(self, ttfb: float):
+        if self.ewma_ttfb is None:
+            self.ewma_ttfb = ttfb
+        else:
+            alpha = settings.llm_load_balancing_ewma_alpha
+            self.ewma_ttfb = alpha * ttfb + (1 - alpha) * self.ewma_ttfb
+
+    def record_rate_limits(self, headers: Headers, status_code: int):
+        if status_code == 429:
+            retry_after = parse_retry_after(headers)
+        else:
+            retry_after = parse_ratelimit_exhausted(headers)
+            if retry_after is None:
+                return
+        self.throttle(retry_after or settings.llm_retry_ratelimit_cooldown)
+
+    def throttle(self, seconds: float):
+        self.throttled_until = max(self.throttled_until, monotonic() + seconds)
+
+    def throttled_for(self) -> float:
+        return max(0.0, self.throttled_until - monotonic())
+
+    def is_throttled(self) -> bool:
+        return self.throttled_until > monotonic()
+
+    def load_score(self) -> float:
+        if self.ewma_ttfb is None:
+            # Let a single probe through until we have a latency estimate
+            return 0.0 if self.in_flight == 0 else math.inf
+        return self.ewma_ttfb * (self.in_flight + 1)
+
+    def to_dict(self):
+        return {
+            "id": self.instance_id,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ewma_ttfb": self.ewma_ttfb,
+            "throttled_for": self.throttled_for(),
+            "circuit_breaker": self.breaker.to_dict(),
+            "quota": self.quota.to_dict(),
+        }
+
+
+class RequestTracker:
+    """Tracks a single upstream request against the stats of its instance."""
+
+    def __init__(
+        self,
+        stats: InstanceStats,
+        retryable: bool = False,
+        tokens: int = 0,
+        usage_callback: typing.Callable[[int], None] | None = None,
+        response_callback: typing.Callable[[dict], None] | None = None,
+    ) -> None:
+        self.stats = stats
+        self.retryable = retryable
+        self.estimated_tokens = tokens
+        self.usage_callback = usage_callback
+        self.usage_recorded = False
+        self.response_callback = response_callback
+        self.status_code: int | None = None
+        self.start_time = perf_counter()
+        self.ttfb: float | None = None
+        self.latency: float | None = None
+        self.finished = False
+        self.probe = stats.breaker.on_request_start()
+        stats.in_flight += 1
+        stats.requests += 1
+        stats.quota.reserve(tokens)
+
+    async def on_response(self, response: Response, stream: bool = False):
+        self.status_code = response.status_code
+        self.stats.record_rate_limits(response.headers, response.status_code)
+        if self.retryable and response.status_code in settings.llm_retry_status_codes:
+            self.finish(error=response.status_code >= 500)
+            await response.aclose()
+            raise RetryableUpstreamError(
+                response.status_code, parse_retry_after(response.headers)
+            )
+        if not stream:
+            self.first_byte()
+            self.finish(error=response.status_code >= 500)
+
+    def record_response(self, response: dict):
+        """Record the usage of a parsed (or merged streamed) response."""
+        self.record_usage(response.get("usage"))
+        if self.response_callback is not None and self.status_code == 200:
+            self.response_callback(response)
+
+    def record_usage(self, usage: dict | None):
+        if self.usage_recorded or not usage or "total_tokens" not in usage:
+            return
+        self.usage_recorded = True
+        self.stats.quota.reconcile(self.estimated_tokens, usage["total_tokens"])
+        if self.usage_callback is not None:
+            self.usage_callback(usage["total_tokens"])
+
+    def log_metadata(self) -> dict:
+        return {
+            "instance": self.stats.instance_id,
+            "status_code": self.status_code,
+            "ttfb": self.ttfb,
+            "latency": self.latency,
+        }
+
+    def first_byte(self):
+        if self.ttfb is None:
+            self.ttfb = perf_counter() - self.start_time
+            self.stats.record_ttfb(self.ttfb)
+
+    def finish(self, error: bool = False, counted: bool = True):
+        if self.finished:
+            return
+        self.finished = True
+        self.latency = perf_counter() - self.start_time
+        self.stats.in_flight -= 1
+        if self.status_code != 200 and not self.usage_recorded:
+            # Failed attempts use no tokens, release what was reserved for them
+            self.usage_recorded = True
+            self.stats.quota.reconcile(self.estimated_tokens, 0)
+        if not counted:
+            # Not down to the instance, e.g. our connection pool was exhausted
+            self.stats.breaker.release(self.probe)
+            return
+        if error:
+            self.stats.errors += 1
+        slow = (
+            self.ttfb is not None
+            and self.ttfb > settings.llm_circuit_breaker_slow_threshold
+        )
+        self.stats.breaker.on_request_end(not error and not slow, self.probe)
+
+
+@dataclass(frozen=True, slots=True)
+class InstanceRecord:
+    id: str
+    provider: type
+    endpoints: dict[str, typing.Callable]
+    params: dict
+    urls: dict[str, str]
+    headers: dict[str, str]
+    stats: InstanceStats
+    stream_include_usage: bool
+    embedding_batcher: EmbeddingBatcher | None
+    requests_client: AsyncClient | None
+    pool_stats: PoolStats | None
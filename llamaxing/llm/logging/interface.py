@@ -6,10 +6,16 @@ class LoggingClientInterface(ABC):
     def __init__(self) -> None:
         pass
 
+    async def on_startup(self):  # noqa: B027
+        pass
+
     @abstractmethod
     async def on_shutdown(self):
         pass
 
+    def get_stats(self) -> dict | None:
+        return None
+
     @abstractmethod
     async def log_api_call(self, endpoint, metadata, request, response):
         pass
@@ -1,27 +1,225 @@
+import asyncio
+import contextlib
+import os
+import threading
+
+import json_codec
 from llm.logging import LoggingClientInterface
-from logging_utils import log_exception
+from llm.logging.spool import Spool
+from logging_utils import log_exception, logger
 from motor.motor_asyncio import AsyncIOMotorClient
 from settings import settings
 
+OVERFLOW_POLICIES = ("drop", "block", "spill")
+
 
 class LoggingClient(LoggingClientInterface):
+    """Logs API calls to MongoDB in batches.
+
+    Records are put on a bounded queue and written with insert_many by a
+    single flusher task, once logging_client_mongodb_batch_size records are
+    waiting or every logging_client_mongodb_flush_interval seconds. When the
+    queue is full, records are dropped, the caller waits for room, or the
+    records are appended to a spill file that is written to MongoDB on the
+    next start, depending on logging_client_mongodb_overflow.
+
+    With logging_client_mongodb_spool, records are instead appended to a local
+    spool before log_api_call returns, and a task drains the spool to MongoDB
+    in batches, retrying until MongoDB is available. Records are written at
+    least once, also across restarts.
+    """
+
     def __init__(self) -> None:
+        if settings.logging_client_mongodb_overflow not in OVERFLOW_POLICIES:
+            raise ValueError(
+                f"Invalid overflow policy {settings.logging_client_mongodb_overflow}"
+            )
         self.client = AsyncIOMotorClient(settings.logging_client_mongodb_uri)
         self.db = self.client[settings.logging_client_mongodb_db_name]
         self.collection = self.db["apicalls"]
+        self.queue = asyncio.Queue(settings.logging_client_mongodb_queue_size)
+        self.batch_ready = asyncio.Event()
+        self.spill_lock = threading.Lock()
+        self.stopping = False
+        self.task = None
+        self.spool = None
+        self.spooled = asyncio.Event()
+        self.drainer = None
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "batches": 0,
+            "failed": 0,
+            "dropped": 0,
+            "spilled": 0,
+            "spooled": 0,
+        }
+
+    async def on_startup(self):
+        await self.replay_spill()
+        if settings.logging_client_mongodb_spool:
+            self.spool = await asyncio.to_thread(
+                Spool,
+                settings.logging_client_mongodb_spool_path,
+                settings.logging_client_mongodb_spool_segment_bytes,
+                settings.logging_client_mongodb_spool_max_bytes,
+                settings.logging_client_mongodb_spool_fsync,
+            )
+            self.drainer = asyncio.create_task(self.drain())
+        else:
+            self.task = asyncio.create_task(self.run())
 
     async def on_shutdown(self):
+        self.stopping = True
+        self.batch_ready.set()
+        if self.task is not None:
+            await asyncio.wait([self.task], timeout=10)
+        if not self.queue.empty():
+            logger.warning(f"Dropping {self.queue.qsize()} API call logs on shutdown")
+        if self.drainer is not None:
+            # Whatever isn't drained in time is written after the next start
+            self.spooled.set()
+            await asyncio.wait([self.drainer], timeout=5)
+            self.drainer.cancel()
         self.client.close()
 
+    def get_stats(self):
+        stats = {**self.stats, "queue_size": self.queue.qsize()}
+        if self.spool is not None:
+            stats["spool_bytes"] = self.spool.size()
+            stats["spool_dropped"] = self.spool.dropped
+        return stats
+
     async def log_api_call(self, endpoint, metadata, request, response):
+        record = {
+            "endpoint": endpoint,
+            "metadata": metadata,
+            "request": request,
+            "response": response,
+        }
+        if self.spool is not None:
+            # Only acknowledge the record once it is in the spool
+            await self.append_spool([record])
+            return
         try:
-            await self.collection.insert_one(
-                {
-                    "endpoint": endpoint,
-                    "metadata": metadata,
-                    "request": request,
-                    "response": response,
-                }
-            )
+            self.queue.put_nowait(record)
+        except asyncio.QueueFull:
+            policy = settings.logging_client_mongodb_overflow
+            if policy == "block":
+                await self.queue.put(record)
+            elif policy == "spill":
+                await self.spill([record])
+                return
+            else:
+                self.stats["dropped"] += 1
+                return
+        self.stats["queued"] += 1
+        if self.queue.qsize() >= settings.logging_client_mongodb_batch_size:
+            self.batch_ready.set()
+
+    async def run(self):
+        batch_size = settings.logging_client_mongodb_batch_size
+        while not self.stopping or not self.queue.empty():
+            if not self.stopping and self.queue.qsize() < batch_size:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        self.batch_ready.wait(),
+                        settings.logging_client_mongodb_flush_interval,
+                    )
+            self.batch_ready.clear()
+            while not self.queue.empty():
+                size = min(batch_size, self.queue.qsize())
+                batch = [self.queue.get_nowait() for _ in range(size)]
+                await self.write(batch)
+
+    async def append_spool(self, batch: list[dict]):
+        try:
+            await asyncio.to_thread(self.spool.append, batch)
+            self.stats["spooled"] += len(batch)
+            self.spooled.set()
+        except Exception:
+            log_exception()
+            await self.write(batch)
+
+    async def drain(self):
+        batch_size = settings.logging_client_mongodb_batch_size
+        backoff = 0.0
+        while True:
+            records, position = await asyncio.to_thread(self.spool.read, batch_size)
+            if len(records) == 0:
+                if self.stopping:
+                    return
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        self.spooled.wait(),
+                        settings.logging_client_mongodb_flush_interval,
+                    )
+                self.spooled.clear()
+                continue
+            try:
+                await self.collection.insert_many(records, ordered=False)
+            except Exception:
+                log_exception()
+                self.stats["failed"] += len(records)
+                if self.stopping:
+                    return
+                backoff = min(max(2 * backoff, 1.0), 30.0)
+                await asyncio.sleep(backoff)
+                continue
+            backoff = 0.0
+            self.stats["written"] += len(records)
+            self.stats["batches"] += 1
+            await asyncio.to_thread(self.spool.commit, position)
+
+    async def write(self, batch: list[dict]):
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        except Exception:
+            log_exception()
+            self.stats["failed"] += len(batch)
+            if settings.logging_client_mongodb_overflow == "spill":
+                for record in batch:
+                    # Added by insert_many and not JSON serializable
+                    record.pop("_id", None)
+                await self.spill(batch)
+
+    async def spill(self, records: list[dict]):
+        try:
+            await asyncio.to_thread(self.append_spill, records)
+            self.stats["spilled"] += len(records)
+        except Exception:
+            log_exception()
+            self.stats["dropped"] += len(records)
+
+    def append_spill(self, records: list[dict]):
+        path = settings.logging_client_mongodb_spill_path
+        lines = b"".join(json_codec.dumps(x) + b"\n" for x in records)
+        with self.spill_lock:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "ab") as f:
+                f.write(lines)
+
+    def take_spill(self) -> list[dict]:
+        path = settings.logging_client_mongodb_spill_path
+        with self.spill_lock:
+            if not os.path.exists(path):
+                return []
+            with open(path, "rb") as f:
+                records = [json_codec.loads(x) for x in f if x.strip()]
+            os.remove(path)
+        return records
+
+    async def replay_spill(self):
+        try:
+            records = await asyncio.to_thread(self.take_spill)
         except Exception:
             log_exception()
+            return
+        if len(records) == 0:
+            return
+        logger.info(f"Writing {len(records)} spilled API call logs")
+        batch_size = settings.logging_client_mongodb_batch_size
+        for i in range(0, len(records), batch_size):
+            await self.write(records[i : i + batch_size])
@@ -0,0 +1,145 @@
+import asyncio
+import contextlib
+import os
+import uuid
+from datetime import datetime, timezone
+
+import json_codec
+import pyarrow as pa
+import pyarrow.parquet as pq
+from llm.logging import LoggingClientInterface
+from logging_utils import log_exception, logger
+from settings import settings
+
+SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("ms", tz="UTC")),
+        ("endpoint", pa.string()),
+        ("identity_id", pa.string()),
+        ("identity_name", pa.string()),
+        ("model", pa.string()),
+        ("response_model", pa.string()),
+        ("instance", pa.string()),
+        ("status_code", pa.int32()),
+        ("latency", pa.float64()),
+        ("ttfb", pa.float64()),
+        ("prompt_tokens", pa.int64()),
+        ("completion_tokens", pa.int64()),
+        ("total_tokens", pa.int64()),
+        ("stream", pa.bool_()),
+        ("request", pa.string()),
+        ("response", pa.string()),
+    ]
+)
+
+
+def flatten(endpoint, metadata, request, response) -> dict:
+    caller = metadata.get("caller") or {}
+    request = request if isinstance(request, dict) else {}
+    response = response if isinstance(response, dict) else {}
+    usage = response.get("usage") or {}
+    row = {
+        "timestamp": datetime.now(timezone.utc),
+        "endpoint": endpoint,
+        "identity_id": caller.get("id"),
+        "identity_name": caller.get("name"),
+        "model": request.get("model"),
+        "response_model": response.get("model"),
+        "instance": metadata.get("instance"),
+        "status_code": metadata.get("status_code"),
+        "latency": metadata.get("latency"),
+        "ttfb": metadata.get("ttfb"),
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "total_tokens": usage.get("total_tokens"),
+        "stream": request.get("stream") is True,
+        "request": None,
+        "response": None,
+    }
+    if settings.logging_client_parquet_payloads:
+        row["request"] = json_codec.dumps(request).decode()
+        row["response"] = json_codec.dumps(response).decode()
+    return row
+
+
+class LoggingClient(LoggingClientInterface):
+    """Logs API calls to compressed Parquet files with one row per call.
+
+    Rows are buffered in memory and written to a new file, in a directory per
+    day, every logging_client_parquet_flush_interval seconds or once
+    logging_client_parquet_flush_rows rows are waiting. At most
+    logging_client_parquet_max_rows rows are buffered, further calls are
+    dropped and counted until the buffer has been written. Files are written in
+    a thread and only appear under their final name once complete, so the
+    directory can be queried while the gateway is running.
+    """
+
+    def __init__(self) -> None:
+        self.rows: list[dict] = []
+        self.rows_ready = asyncio.Event()
+        self.stopping = False
+        self.task = None
+        self.stats = {"logged": 0, "written": 0, "files": 0, "dropped": 0}
+
+    async def on_startup(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def on_shutdown(self):
+        self.stopping = True
+        self.rows_ready.set()
+        if self.task is not None:
+            await asyncio.wait([self.task], timeout=10)
+        if len(self.rows) > 0:
+            logger.warning(f"Dropping {len(self.rows)} API call logs on shutdown")
+
+    def get_stats(self):
+        return {**self.stats, "buffered": len(self.rows)}
+
+    async def log_api_call(self, endpoint, metadata, request, response):
+        if len(self.rows) >= settings.logging_client_parquet_max_rows:
+            # Files aren't being written fast enough (or at all)
+            self.stats["dropped"] += 1
+            return
+        try:
+            self.rows.append(flatten(endpoint, metadata, request, response))
+        except Exception:
+            log_exception()
+            return
+        self.stats["logged"] += 1
+        if len(self.rows) >= settings.logging_client_parquet_flush_rows:
+            self.rows_ready.set()
+
+    async def run(self):
+        while not self.stopping or len(self.rows) > 0:
+            if not self.stopping:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        self.rows_ready.wait(),
+                        settings.logging_client_parquet_flush_interval,
+                    )
+            self.rows_ready.clear()
+            if len(self.rows) == 0:
+                continue
+            rows, self.rows = self.rows, []
+            try:
+                await asyncio.to_thread(self.write_file, rows)
+                self.stats["written"] += len(rows)
+                self.stats["files"] += 1
+            except Exception:
+                log_exception()
+                self.stats["dropped"] += len(rows)
+
+    def write_file(self, rows: list[dict]):
+        now = datetime.now(timezone.utc)
+        directory = os.path.join(
+            settings.logging_client_parquet_path, f"date={now:%Y-%m-%d}"
+        )
+        os.makedirs(directory, exist_ok=True)
+        name = f"apicalls-{now:%H%M%S}-{uuid.uuid4().hex[:8]}.parquet"
+        tmp_path = os.path.join(directory, f".{name}.tmp")
+        pq.write_table(
+            pa.Table.from_pylist(rows, schema=SCHEMA),
+            tmp_path,
+            compression=settings.logging_client_parquet_compression,
+        )
+        os.replace(tmp_path, os.path.join(directory, name))
@@ -0,0 +1,134 @@
+import json
+import os
+import re
+import threading
+
+import json_codec
+from logging_utils import logger
+
+SEGMENT_NAME = re.compile(r"^(\d{12})\.jsonl$")
+
+
+class Spool:
+    """Append-only log of JSON records kept in numbered segment files.
+
+    Records are appended to the newest segment, which is rolled over once it
+    reaches segment_bytes. They are read back in order from the position in
+    the checkpoint file, which is only moved on by commit, so records that
+    were not committed are read again after a restart. Segments are deleted
+    once they have been read and committed. If the spool grows beyond
+    max_bytes, its oldest segments are dropped.
+
+    The methods block on file I/O and are meant to be run in a thread.
+    """
+
+    def __init__(
+        self, path: str, segment_bytes: int, max_bytes: int, fsync: bool = True
+    ) -> None:
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+        self.segments = sorted(
+            int(m.group(1))
+            for m in map(SEGMENT_NAME.match, os.listdir(path))
+            if m is not None
+        )
+        self.sizes = {x: os.path.getsize(self.segment_path(x)) for x in self.segments}
+        self.position = self.load_checkpoint()
+        # A previous process may have died in the middle of a write, so never
+        # append to a segment it left behind
+        self.new_segment(self.segments[-1] + 1 if self.segments else 0)
+        if self.position[0] not in self.sizes:
+            self.position = (self.segments[0], 0)
+
+    def new_segment(self, segment: int):
+        open(self.segment_path(segment), "ab").close()
+        self.current = segment
+        self.segments.append(segment)
+        self.sizes[segment] = 0
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:012d}.jsonl")
+
+    def load_checkpoint(self) -> tuple[int, int]:
+        try:
+            with open(os.path.join(self.path, "checkpoint")) as f:
+                checkpoint = json.load(f)
+            return checkpoint["segment"], checkpoint["offset"]
+        except FileNotFoundError:
+            return (self.segments[0] if self.segments else 0, 0)
+
+    def size(self) -> int:
+        return sum(self.sizes.values())
+
+    def append(self, records: list[dict]):
+        data = b"".join(json_codec.dumps(x) + b"\n" for x in records)
+        with self.lock:
+            with open(self.segment_path(self.current), "ab") as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.sizes[self.current] += len(data)
+            if self.sizes[self.current] >= self.segment_bytes:
+                self.new_segment(self.current + 1)
+            self.enforce_max_bytes()
+
+    def enforce_max_bytes(self):
+        while self.size() > self.max_bytes and self.segments[0] != self.current:
+            segment = self.segments.pop(0)
+            path = self.segment_path(segment)
+            with open(path, "rb") as f:
+                if segment == self.position[0]:
+                    f.seek(self.position[1])
+                dropped = sum(1 for _ in f)
+            os.remove(path)
+            del self.sizes[segment]
+            self.dropped += dropped
+            logger.warning(f"Spool {self.path} is full, dropped {dropped} records")
+            if segment == self.position[0]:
+                self.position = (self.segments[0], 0)
+
+    def read(self, max_records: int) -> tuple[list[dict], tuple[int, int]]:
+        """Return up to max_records records after the checkpoint and the
+        position to commit once they have been handled."""
+        with self.lock:
+            segment, offset = self.position
+            records = []
+            while len(records) < max_records:
+                with open(self.segment_path(segment), "rb") as f:
+                    f.seek(offset)
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            # Cut short by a crash
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(json_codec.loads(line))
+                        except ValueError:
+                            logger.warning(f"Skipping corrupt record in {f.name}")
+                        if len(records) >= max_records:
+                            break
+                if len(records) >= max_records or segment == self.current:
+                    break
+                segment, offset = self.segments[self.segments.index(segment) + 1], 0
+            return records, (segment, offset)
+
+    def commit(self, position: tuple[int, int]):
+        with self.lock:
+            if position[0] not in self.sizes:
+                # Dropped in the meantime
+                return
+            self.position = position
+            tmp_path = os.path.join(self.path, "checkpoint.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"segment": position[0], "offset": position[1]}, f)
+            os.replace(tmp_path, os.path.join(self.path, "checkpoint"))
+            while self.segments[0] < position[0]:
+                segment = self.segments.pop(0)
+                os.remove(self.segment_path(segment))
+                del self.sizes[segment]
@@ -1 +1 @@
-from .interface import LLMProviderInterface  # noqa: F401
+from .interface import ENDPOINT_PATHS, LLMProviderInterface  # noqa: F401
@@ -2,55 +2,121 @@ from abc import ABC, abstractmethod
 
 from httpx import AsyncClient
 from identity import Identity
+from llm.instance import InstanceRecord, RequestTracker
 from llm.logging import LoggingClientInterface
+from llm.wrappers import (
+    chat_completions_wrapper,
+    completions_wrapper,
+    embeddings_wrapper,
+    images_generations_wrapper,
+)
 from observability import ObservabilityClientInterface
 
+ENDPOINT_PATHS = {
+    "chat_completions": "chat/completions",
+    "completions": "completions",
+    "embeddings": "embeddings",
+    "images_generations": "images/generations",
+}
+
 
 class LLMProviderInterface(ABC):
+    # Whether stream_options is accepted by default, see llm_stream_include_usage
+    stream_options_supported = True
+
+    @staticmethod
+    @abstractmethod
+    def get_url(endpoint_params: dict, endpoint: str) -> str:
+        pass
+
     @staticmethod
     @abstractmethod
+    def get_headers(endpoint_params: dict) -> dict:
+        pass
+
+    @staticmethod
     async def chat_completions(
         data,
         identity: Identity,
         requests_client: AsyncClient,
-        endpoint_params: dict,
-        logging_client: LoggingClientInterface,
-        observability_client: ObservabilityClientInterface,
+        instance: InstanceRecord,
+        logging_client: LoggingClientInterface = None,
+        observability_client: ObservabilityClientInterface = None,
+        tracker: RequestTracker = None,
     ):
-        pass
+        return await chat_completions_wrapper(
+            data,
+            instance.urls["chat_completions"],
+            instance.headers,
+            requests_client,
+            identity,
+            logging_client,
+            observability_client,
+            tracker=tracker,
+            include_usage=instance.stream_include_usage,
+        )
 
     @staticmethod
-    @abstractmethod
     async def completions(
         data,
         identity: Identity,
         requests_client: AsyncClient,
-        endpoint_params: dict,
-        logging_client: LoggingClientInterface,
-        observability_client: ObservabilityClientInterface,
+        instance: InstanceRecord,
+        logging_client: LoggingClientInterface = None,
+        observability_client: ObservabilityClientInterface = None,
+        tracker: RequestTracker = None,
     ):
-        pass
+        return await completions_wrapper(
+            data,
+            instance.urls["completions"],
+            instance.headers,
+            requests_client,
+            identity,
+            logging_client,
+            observability_client,
+            tracker=tracker,
+            include_usage=instance.stream_include_usage,
+        )
 
     @staticmethod
-    @abstractmethod
     async def embeddings(
         data,
         identity: Identity,
         requests_client: AsyncClient,
-        endpoint_params: dict,
-        logging_client: LoggingClientInterface,
-        observability_client: ObservabilityClientInterface,
+        instance: InstanceRecord,
+        logging_client: LoggingClientInterface = None,
+        observability_client: ObservabilityClientInterface = None,
+        tracker: RequestTracker = None,
     ):
-        pass
+        return await embeddings_wrapper(
+            data,
+            instance.urls["embeddings"],
+            instance.headers,
+            requests_client,
+            identity,
+            logging_client,
+            observability_client,
+            tracker=tracker,
+            batcher=instance.embedding_batcher,
+        )
 
     @staticmethod
-    @abstractmethod
     async def images_generations(
         data,
         identity: Identity,
         requests_client: AsyncClient,
-        endpoint_params: dict,
-        logging_client: LoggingClientInterface,
-        observability_client: ObservabilityClientInterface,
+        instance: InstanceRecord,
+        logging_client: LoggingClientInterface = None,
+        observability_client: ObservabilityClientInterface = None,
+        tracker: RequestTracker = None,
     ):
-        pass
+        return await images_generations_wrapper(
+            data,
+            instance.urls["images_generations"],
+            instance.headers,
+            requests_client,
+            identity,
+            logging_client,
+            observability_client,
+            tracker=tracker,
+        )
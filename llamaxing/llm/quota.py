@@ -0,0 +1,59 @@
+from time import monotonic
+
+from settings import settings
+
+
+class SlidingWindowCounter:
+    """Approximate sliding window sum using a ring of fixed-width buckets."""
+
+    def __init__(self, window: float = 60.0, buckets: int = 60) -> None:
+        self.width = window / buckets
+        self.slots = [0] * buckets
+        self.counts = [0] * buckets
+
+    def add(self, amount: int):
+        slot = int(monotonic() / self.width)
+        i = slot % len(self.slots)
+        if self.slots[i] != slot:
+            self.slots[i] = slot
+            self.counts[i] = 0
+        self.counts[i] += amount
+
+    def total(self) -> int:
+        oldest = int(monotonic() / self.width) - len(self.slots)
+        return sum(
+            count
+            for slot, count in zip(self.slots, self.counts, strict=True)
+            if slot > oldest
+        )
+
+
+class InstanceQuota:
+    def __init__(self, tpm: int | None = None, rpm: int | None = None) -> None:
+        self.tpm = tpm
+        self.rpm = rpm
+        self.tokens = SlidingWindowCounter()
+        self.requests = SlidingWindowCounter()
+
+    def has_capacity(self, tokens: int) -> bool:
+        headroom = settings.llm_quota_headroom
+        if self.rpm is not None and self.requests.total() + 1 > self.rpm * headroom:
+            return False
+        return not (
+            self.tpm is not None and self.tokens.total() + tokens > self.tpm * headroom
+        )
+
+    def reserve(self, tokens: int):
+        self.requests.add(1)
+        self.tokens.add(tokens)
+
+    def reconcile(self, estimated_tokens: int, actual_tokens: int):
+        self.tokens.add(actual_tokens - estimated_tokens)
+
+    def to_dict(self):
+        return {
+            "tpm": self.tpm,
+            "rpm": self.rpm,
+            "tokens": self.tokens.total(),
+            "requests": self.requests.total(),
+        }
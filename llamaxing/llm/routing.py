@@ -0,0 +1,141 @@
+import os
+import typing
+from dataclasses import dataclass
+from importlib import import_module
+
+from http_client import PoolStats, build_client, client_options
+from httpx import URL, AsyncClient
+from llm.balancing import LoadBalancerInterface
+from llm.batching import EmbeddingBatcher
+from llm.instance import InstanceRecord, InstanceStats
+from llm.provider import ENDPOINT_PATHS
+from settings import settings
+
+EXPANDED_PARAMS = (
+    "azure_api_key",
+    "azure_deployment",
+    "azure_endpoint",
+    "openai_api_key",
+)
+
+
+@dataclass(frozen=True, slots=True)
+class ModelRecord:
+    id: str
+    capabilities: frozenset[str]
+    instances: tuple[InstanceRecord, ...]
+    load_balancer: LoadBalancerInterface
+    token_limited: bool
+
+
+def default_http_options() -> dict:
+    return {
+        "max_connections": settings.app_requests_max_connections,
+        "max_keepalive_connections": settings.app_requests_max_keepalive_connections,
+        "keepalive_expiry": settings.app_requests_keepalive_expiry,
+        "http2": settings.app_requests_http2,
+        "connect_timeout": settings.app_requests_connect_timeout,
+        "read_timeout": settings.app_requests_timeout,
+        "write_timeout": settings.app_requests_write_timeout,
+        "pool_timeout": settings.app_requests_pool_timeout,
+    }
+
+
+def instance_client(
+    urls: dict[str, str], http: dict, clients: dict
+) -> tuple[AsyncClient, PoolStats]:
+    """Return the client for an instance with its own HTTP options.
+
+    Instances on the same host with the same options share a client. Clients
+    are kept across reloads, as requests in flight may still be using them.
+    """
+    options = client_options(default_http_options(), http)
+    url = URL(next(iter(urls.values())))
+    key = (url.scheme, url.host, url.port, tuple(sorted(options.items())))
+    if key not in clients:
+        clients[key] = build_client(options)
+    return clients[key]
+
+
+def compile_instance(
+    config: dict,
+    stats: InstanceStats | None = None,
+    clients: dict | None = None,
+) -> InstanceRecord:
+    params = {
+        k: os.path.expandvars(v) if k in EXPANDED_PARAMS else v
+        for k, v in config.items()
+    }
+    provider = import_module(f"llm.provider.{params['provider']}").LLMProvider
+    if stats is None:
+        stats = InstanceStats(params["id"], params.get("tpm"), params.get("rpm"))
+    urls = {x: provider.get_url(params, x) for x in ENDPOINT_PATHS}
+    requests_client, pool_stats = None, None
+    if "http" in params:
+        requests_client, pool_stats = instance_client(
+            urls, params["http"], {} if clients is None else clients
+        )
+    return InstanceRecord(
+        id=params["id"],
+        provider=provider,
+        endpoints={x: getattr(provider, x) for x in ENDPOINT_PATHS},
+        params=params,
+        urls=urls,
+        headers=provider.get_headers(params),
+        stats=stats,
+        stream_include_usage=params.get(
+            "stream_include_usage",
+            provider.stream_options_supported
+            if settings.llm_stream_include_usage is None
+            else settings.llm_stream_include_usage,
+        ),
+        embedding_batcher=EmbeddingBatcher()
+        if settings.llm_embedding_batching
+        else None,
+        requests_client=requests_client,
+        pool_stats=pool_stats,
+    )
+
+
+def compile_routing_table(
+    models: list[dict],
+    stats: dict[str, InstanceStats] | None = None,
+    clients: dict | None = None,
+) -> dict[str, ModelRecord]:
+    """Build a lookup table from model IDs and aliases to model records.
+
+    Stats of instances in a previous table can be passed in to carry them over,
+    and HTTP clients of instances are taken from and added to clients.
+    """
+    if stats is None:
+        stats = {}
+    table = {}
+    for m in models:
+        load_balancing = m.get("load_balancing", settings.llm_load_balancing)
+        balancing_module = import_module(f"llm.balancing.{load_balancing}")
+        instances = tuple(
+            compile_instance(x, stats.get(x["id"]), clients) for x in m["instances"]
+        )
+        record = ModelRecord(
+            id=m["id"],
+            capabilities=frozenset(m["capabilities"]),
+            instances=instances,
+            load_balancer=balancing_module.LoadBalancer(),
+            token_limited=any(x.params.get("tpm") is not None for x in instances),
+        )
+        for name in [m["id"], *m.get("aliases", [])]:
+            if name in table:
+                raise ValueError(f"Model {name} is defined more than once")
+            table[name] = record
+    return table
+
+
+def apply_quotas(instances: typing.Iterable[InstanceRecord]):
+    """Update the quotas of stats carried over from a previous table.
+
+    This is done only once the new table is in use, so a table that fails
+    to compile leaves the current quotas alone.
+    """
+    for x in instances:
+        x.stats.quota.tpm = x.params.get("tpm")
+        x.stats.quota.rpm = x.params.get("rpm")
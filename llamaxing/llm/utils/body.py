@@ -0,0 +1,212 @@
+import re
+from collections.abc import Mapping
+from functools import cached_property
+
+import json_codec
+from starlette.requests import Request
+
+_WHITESPACE = re.compile(rb"[ \t\n\r]*")
+_SCALAR = re.compile(rb"[^,}\] \t\n\r]+")
+_STRUCTURAL = re.compile(rb'["\[\]{}]')
+
+# Top-level fields the gateway needs before (or instead of) decoding the body
+SCANNED_FIELDS = ("model", "stream", "stream_options", "observation_metadata")
+
+
+def _skip_whitespace(raw: bytes, pos: int) -> int:
+    return _WHITESPACE.match(raw, pos).end()
+
+
+def _skip_string(raw: bytes, pos: int) -> int:
+    while True:
+        end = raw.find(b'"', pos + 1)
+        if end < 0:
+            raise ValueError("Unterminated string")
+        backslash = end - 1
+        while raw[backslash] == 0x5C:
+            backslash -= 1
+        if (end - 1 - backslash) % 2 == 0:
+            return end + 1
+        pos = end
+
+
+def _skip_container(raw: bytes, pos: int) -> int:
+    depth = 0
+    while True:
+        match = _STRUCTURAL.search(raw, pos)
+        if match is None:
+            raise ValueError("Unterminated container")
+        pos = match.start()
+        char = raw[pos]
+        if char == 0x22:
+            pos = _skip_string(raw, pos)
+            continue
+        depth += 1 if char in (0x5B, 0x7B) else -1
+        pos += 1
+        if depth == 0:
+            return pos
+
+
+def _skip_value(raw: bytes, pos: int) -> int:
+    char = raw[pos : pos + 1]
+    if char == b'"':
+        return _skip_string(raw, pos)
+    if char in (b"{", b"["):
+        return _skip_container(raw, pos)
+    match = _SCALAR.match(raw, pos)
+    if match is None:
+        raise ValueError(f"Unexpected value at position {pos}")
+    return match.end()
+
+
+def scan_members(raw: bytes) -> list[tuple[str, int, int, int]]:
+    """Locate the members of a top-level JSON object without decoding the values.
+
+    Returns (key, key_start, value_start, value_end) for every member. Nested
+    values are only walked structurally, so large strings are skipped in C.
+    """
+    pos = _skip_whitespace(raw, 0)
+    if raw[pos : pos + 1] != b"{":
+        raise ValueError("Body is not a JSON object")
+    pos = _skip_whitespace(raw, pos + 1)
+    members = []
+    if raw[pos : pos + 1] == b"}":
+        return members
+    while True:
+        if raw[pos : pos + 1] != b'"':
+            raise ValueError(f"Expected key at position {pos}")
+        key_start = pos
+        pos = _skip_string(raw, pos)
+        key = json_codec.loads(raw[key_start:pos])
+        pos = _skip_whitespace(raw, pos)
+        if raw[pos : pos + 1] != b":":
+            raise ValueError(f"Expected ':' at position {pos}")
+        value_start = _skip_whitespace(raw, pos + 1)
+        value_end = _skip_value(raw, value_start)
+        members.append((key, key_start, value_start, value_end))
+        pos = _skip_whitespace(raw, value_end)
+        char = raw[pos : pos + 1]
+        if char == b"}":
+            return members
+        if char != b",":
+            raise ValueError(f"Expected ',' or '}}' at position {pos}")
+        pos = _skip_whitespace(raw, pos + 1)
+
+
+class RequestBody(Mapping):
+    """Raw request body that is forwarded upstream without being re-encoded.
+
+    The fields in SCANNED_FIELDS are decoded on their own; any other access
+    decodes the full body once and caches the result.
+    """
+
+    def __init__(self, raw: bytes, members: list = None):
+        self.raw = raw
+        self.members = scan_members(raw) if members is None else members
+        self.fields = {}
+        for key, _, value_start, value_end in self.members:
+            if key in SCANNED_FIELDS:
+                self.fields[key] = json_codec.loads(raw[value_start:value_end])
+
+    @cached_property
+    def data(self) -> dict:
+        return json_codec.loads(self.raw)
+
+    def __getitem__(self, key):
+        if key in SCANNED_FIELDS:
+            return self.fields[key]
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return f"RequestBody(model={self.fields.get('model')!r}, {len(self.raw)} bytes)"
+
+    def without(self, key: str) -> "RequestBody":
+        """Return a body with the top-level key spliced out of the raw bytes."""
+        index = next(
+            (i for i, m in enumerate(self.members) if m[0] == key),
+            None,
+        )
+        if index is None:
+            return self
+        if index + 1 < len(self.members):
+            # Cut up to the next key, taking the trailing comma with it
+            start, end = self.members[index][1], self.members[index + 1][1]
+        elif index > 0:
+            # Last member: cut from the end of the previous value
+            start, end = self.members[index - 1][3], self.members[index][3]
+        else:
+            start, end = self.members[index][1], self.members[index][3]
+        shift = end - start
+        members = [
+            m if i < index else (m[0], m[1] - shift, m[2] - shift, m[3] - shift)
+            for i, m in enumerate(self.members)
+            if i != index
+        ]
+        return RequestBody(self.raw[:start] + self.raw[end:], members)
+
+    def with_field(self, key: str, value) -> "RequestBody":
+        """Return a body with a top-level key set, splicing in the encoded value."""
+        encoded = json_codec.dumps(value)
+        member = next((m for m in self.members if m[0] == key), None)
+        if member is not None:
+            raw = self.raw[: member[2]] + encoded + self.raw[member[3] :]
+        else:
+            end = self.raw.rindex(b"}")
+            separator = b"," if self.members else b""
+            raw = (
+                self.raw[:end]
+                + separator
+                + json_codec.dumps(key)
+                + b":"
+                + encoded
+                + self.raw[end:]
+            )
+        return RequestBody(raw)
+
+
+def split_observation_metadata(data: Mapping) -> tuple[Mapping, dict]:
+    """Separate observation_metadata from the request without mutating it."""
+    observation_metadata = data.get("observation_metadata")
+    if isinstance(data, RequestBody):
+        return data.without("observation_metadata"), observation_metadata
+    data = {k: v for k, v in data.items() if k != "observation_metadata"}
+    return data, observation_metadata
+
+
+def request_stream_usage(data: Mapping) -> tuple[Mapping, bool]:
+    """Ask the upstream to end the stream with a usage chunk.
+
+    Returns the request and whether the option was added, in which case the
+    client did not ask for the usage chunk itself.
+    """
+    stream_options = data.get("stream_options") or {}
+    if stream_options.get("include_usage"):
+        return data, False
+    stream_options = {**stream_options, "include_usage": True}
+    if isinstance(data, RequestBody):
+        return data.with_field("stream_options", stream_options), True
+    return {**data, "stream_options": stream_options}, True
+
+
+def encode_body(data: Mapping) -> bytes:
+    if isinstance(data, RequestBody):
+        return data.raw
+    return json_codec.dumps(data)
+
+
+def decode_body(data: Mapping) -> dict:
+    if isinstance(data, RequestBody):
+        return data.data
+    return data
+
+
+async def read_request(request: Request, raw: bool = False) -> Mapping:
+    if raw:
+        return RequestBody(await request.body())
+    return json_codec.loads(await request.body())
@@ -0,0 +1,64 @@
+import asyncio
+import typing
+
+from logging_utils import log_exception
+from starlette.background import BackgroundTask
+
+
+class StreamBroadcast:
+    """Reads an upstream stream once and replays it to any number of subscribers.
+
+    Chunks are kept until the stream ends so that late subscribers get the
+    whole stream. The source is read by its own task, so a subscriber going
+    away doesn't cut the stream short for the others.
+    """
+
+    def __init__(
+        self,
+        source: typing.AsyncIterable[bytes],
+        background: BackgroundTask | None = None,
+        on_done: typing.Callable[[], None] | None = None,
+    ) -> None:
+        self.source = source
+        self.background = background
+        self.on_done = on_done
+        self.chunks: list[bytes] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.pump())
+
+    async def pump(self):
+        try:
+            async for chunk in self.source:
+                self.chunks.append(chunk)
+                self.notify()
+        except Exception as e:
+            log_exception()
+            self.error = e
+        finally:
+            self.done = True
+            self.notify()
+            if self.on_done is not None:
+                self.on_done()
+            if self.background is not None:
+                await self.background()
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def subscribe(self) -> typing.AsyncIterator[bytes]:
+        position = 0
+        while True:
+            changed = self.changed
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if position < len(self.chunks):
+                    continue
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
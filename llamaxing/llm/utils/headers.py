@@ -0,0 +1,52 @@
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from httpx import Headers
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> float | None:
+    """Parse durations such as "20ms", "1s" or "6m0s" into seconds."""
+    matches = DURATION_PATTERN.findall(value)
+    if len(matches) == 0:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def parse_retry_after(headers: Headers) -> float | None:
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        value = headers["retry-after"]
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def parse_ratelimit_exhausted(headers: Headers) -> float | None:
+    """Return how long to back off if the upstream reports an exhausted quota."""
+    for limit in ("requests", "tokens"):
+        remaining = headers.get(f"x-ratelimit-remaining-{limit}")
+        if remaining is None:
+            continue
+        try:
+            if int(float(remaining)) > 0:
+                continue
+        except ValueError:
+            continue
+        reset = headers.get(f"x-ratelimit-reset-{limit}")
+        return (parse_duration(reset) if reset is not None else None) or 0.0
+    return None
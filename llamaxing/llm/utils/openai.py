@@ -1,147 +1,147 @@
-import json
+from functools import lru_cache
 
+import json_codec
 import tiktoken
 from logging_utils import logger
+from starlette.concurrency import run_in_threadpool
 
+# Model prefixes tiktoken may not know about yet that use the o200k encoding
+O200K_PREFIXES = (
+    "gpt-4o",
+    "gpt-4.1",
+    "gpt-4.5",
+    "gpt-5",
+    "chatgpt-4o",
+    "o1",
+    "o3",
+    "o4",
+)
 
-# Adapted from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb # noqa: E501
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-    """Return the number of tokens used by a list of messages."""
+# Inputs with more characters than this are tokenized in the threadpool
+THREADED_TOKENIZE_THRESHOLD = 16 * 1024
+
+# Texts are encoded with encode_ordinary_batch when there are more than this
+BATCH_ENCODE_THRESHOLD = 32
+
+# Lower bound of the tokens an image in a message counts as (a low detail image)
+IMAGE_TOKENS = 85
+
+
+@lru_cache(maxsize=256)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the encoding for a model, cached per process."""
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        logger.warning("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-1106",
-        "gpt-3.5-turbo-0125",
-        "gpt-3.5-turbo-16k",
-        "gpt-3.5-turbo-16k-0613",
-    } or model.startswith("gpt-4"):
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
+        pass
+    if model.startswith(O200K_PREFIXES):
+        return tiktoken.get_encoding("o200k_base")
+    logger.warning(f"Model {model} not known to tiktoken, using cl100k_base encoding")
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def warm_up(models) -> None:
+    """Load the encodings for the given models so the first request doesn't."""
+    for model in models:
+        try:
+            get_encoding(model).encode_ordinary("warm up")
+        except Exception:
+            logger.warning(f"Failed to load tokenizer for model {model}")
+
+
+def num_tokens_from_texts(texts: list[str], model: str) -> int:
+    encoding = get_encoding(model)
+    if len(texts) > BATCH_ENCODE_THRESHOLD:
+        return sum(len(x) for x in encoding.encode_ordinary_batch(texts))
+    return sum(len(encoding.encode_ordinary(x)) for x in texts)
+
+
+# Adapted from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb # noqa: E501
+def messages_texts(messages, model="gpt-3.5-turbo-0613") -> tuple[list[str], int]:
+    """Return the texts to tokenize for a list of messages and the number of
+    tokens the message formatting adds on top of them."""
+    if model == "gpt-3.5-turbo-0301":
         tokens_per_message = (
             4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         )
         tokens_per_name = -1  # if there's a name, the role is omitted
     else:
-        raise NotImplementedError(
-            f"num_tokens_from_messages() is not implemented for model {model}. "
-            "See https://github.com/openai/openai-python/blob/main/chatml.md for "
-            "information on how messages are converted to tokens."
-        )
-    num_tokens = 0
+        tokens_per_message = 3
+        tokens_per_name = 1
+    texts = []
+    num_tokens = 3  # every reply is primed with <|start|>assistant<|message|>
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
+            if isinstance(value, str):
+                texts.append(value)
+            elif key == "content" and isinstance(value, list):
+                for part in value:
+                    if part.get("type") == "text":
+                        texts.append(part.get("text") or "")
+                    else:
+                        num_tokens += IMAGE_TOKENS
+            elif value is not None:
+                # Tool calls and the like, approximated by their JSON
+                texts.append(json_codec.dumps(value).decode())
             if key == "name":
                 num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    return texts, num_tokens
+
+
+def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
+    """Return the number of tokens used by a list of messages."""
+    texts, num_tokens = messages_texts(messages, model)
+    return num_tokens + num_tokens_from_texts(texts, model)
 
 
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    encoding = tiktoken.encoding_for_model(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
-
-
-def merge_response_chunks(chunks, object_type="chat.completion.chunk"):
-    if object_type not in ("chat.completion.chunk", "text_completion"):
-        raise Exception("Invalid object type")
-
-    merged_response = ""
-    merge_successful = False
-    token_count = 0
-    valid_chunks = 0
-
-    if not isinstance(chunks, list):
-        raise Exception("Input should be a list")
-    if len(chunks) == 0:
-        raise Exception("Input list has length 0")
-
-    chunks = "".join(chunks)
-    chunks = chunks.split("\n\n")
-
-    # Process chunks
-    for chunk in chunks:
-        if len(chunk) < 5:
-            # Chunk is empty!
-            break
-
-        chunk_prefix = chunk[:5]
-        if chunk_prefix != "data:":
-            # Unexpected format!
-            break
-
-        # Are we done?
-        chunk_data = chunk[6:]
-        if chunk_data.strip() == "[DONE]":
-            merge_successful = True
-            break
-        # If not, parse data:
-        try:
-            chunk_data = json.loads(chunk_data)
-        except Exception:
-            break
-
-        # Is the chunk actually a completion chunk?
-        if chunk_data["object"] == object_type:
-            valid_chunks += 1
-        else:
-            # Otherwise, skip it
-            continue
-
-        if object_type == "chat.completion.chunk":
-            # Is this the first chunk?
-            if valid_chunks == 1:
-                merged_response = chunk_data
-                if "content" not in merged_response["choices"][0]["delta"]:
-                    merged_response["choices"][0]["delta"]["content"] = ""
-            elif valid_chunks > 1:
-                delta = chunk_data["choices"][0]["delta"]
-                if "content" in delta:
-                    token_count += 1
-                    merged_response["choices"][0]["delta"]["content"] += delta[
-                        "content"
-                    ]
-                if "finish_reason" in chunk_data["choices"][0]:
-                    merged_response["choices"][0]["finish_reason"] = chunk_data[
-                        "choices"
-                    ][0]["finish_reason"]
-        elif object_type == "text_completion":
-            # Is this the first chunk?
-            if valid_chunks == 1:
-                merged_response = chunk_data
-                if "text" not in merged_response["choices"][0]:
-                    merged_response["choices"][0]["text"] = ""
-            elif valid_chunks > 1:
-                delta = chunk_data["choices"][0]
-                if "text" in delta:
-                    token_count += 1
-                    merged_response["choices"][0]["text"] += delta["text"]
-                if "finish_reason" in chunk_data["choices"][0]:
-                    merged_response["choices"][0]["finish_reason"] = chunk_data[
-                        "choices"
-                    ][0]["finish_reason"]
-
-    if valid_chunks == 0:
-        raise Exception("Merge failed - did not find any valid chunks!")
-
-    if object_type == "chat.completion.chunk":
-        # Rename delta key to match non-streaming response
-        merged_response["choices"][0]["message"] = merged_response["choices"][0].pop(
-            "delta"
-        )
+    return len(get_encoding(encoding_name).encode_ordinary(string))
+
+
+def request_texts(endpoint: str, data: dict, model: str) -> tuple[list[str], int]:
+    """Return the texts to tokenize for a request and the tokens it counts
+    against a deployment's TPM limit on top of them."""
+    if endpoint == "chat_completions":
+        texts, num_tokens = messages_texts(data["messages"], model)
+    elif endpoint in ("completions", "embeddings"):
+        inputs = data.get("prompt" if endpoint == "completions" else "input", "")
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        texts, num_tokens = [x for x in inputs if isinstance(x, str)], 0
+    else:
+        return [], 0
+    max_tokens = data.get("max_tokens") or 0
+    return texts, num_tokens + max_tokens * (data.get("n") or 1)
+
 
-    # Add more info
-    if merge_successful:
-        merged_response["usage"] = {"completion_tokens": token_count}
-    merged_response["streaming_response"] = True
-    merged_response["stream_merge_successful"] = merge_successful
+async def num_tokens_from_request(endpoint: str, data: dict, model: str) -> int:
+    """Estimate the tokens a request counts against a deployment's TPM limit.
 
-    return merged_response
+    Large inputs are tokenized in the threadpool to keep the event loop free.
+    """
+    texts, num_tokens = request_texts(endpoint, data, model)
+    if sum(len(x) for x in texts) > THREADED_TOKENIZE_THRESHOLD:
+        return num_tokens + await run_in_threadpool(num_tokens_from_texts, texts, model)
+    return num_tokens + num_tokens_from_texts(texts, model)
+
+
+def estimate_stream_usage(data: dict, response: dict) -> dict:
+    """Count the usage of a merged stream locally, as a fallback for upstreams
+    that do not send a usage chunk."""
+    model = response.get("model") or data["model"]
+    if "messages" in data:
+        prompt_tokens = num_tokens_from_messages(data["messages"], model)
+        outputs = [x["message"].get("content") or "" for x in response["choices"]]
+    else:
+        prompts = (
+            data["prompt"] if isinstance(data["prompt"], list) else [data["prompt"]]
+        )
+        prompt_tokens = num_tokens_from_texts(prompts, model)
+        outputs = [x.get("text") or "" for x in response["choices"]]
+    completion_tokens = num_tokens_from_texts(outputs, model)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
@@ -4,10 +4,11 @@ from datetime import datetime, timezone
 from functools import partial
 
 import anyio
-from llm.utils.openai import merge_response_chunks
+from llm.instance import RequestTracker
+from llm.utils.sse import StreamAccumulator
 from logging_utils import log_exception
 from starlette.background import BackgroundTask
-from starlette.concurrency import iterate_in_threadpool
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 from starlette.responses import Response
 from starlette.types import Receive, Scope, Send
 
@@ -29,10 +30,12 @@ class LoggingStreamingResponse(Response):
         background: BackgroundTask | None = None,
         logger: logging.Logger | None = None,
         log_level: int = 0,
-        prompt_tokens: int = 0,
+        usage_fallback: typing.Callable | None = None,
+        drop_usage_chunk: bool = False,
         object_type: str = "chat.completion.chunk",
         logging_call: typing.Callable | None = None,
         observability_call: typing.Callable | None = None,
+        tracker: RequestTracker | None = None,
     ) -> None:
         if isinstance(content, typing.AsyncIterable):
             self.body_iterator = content
@@ -44,11 +47,21 @@ class LoggingStreamingResponse(Response):
         self.init_headers(headers)
         self.logger = logger
         self.log_level = log_level
-        self.prompt_tokens = prompt_tokens
+        self.usage_fallback = usage_fallback
         self.object_type = object_type
         self.logging_call = logging_call
         self.observability_call = observability_call
-        self.response_chunks = []
+        self.tracker = tracker
+        if (
+            logging_call is not None
+            or observability_call is not None
+            or tracker is not None
+            or log_level > 0
+            or drop_usage_chunk
+        ):
+            self.accumulator = StreamAccumulator(object_type, drop_usage_chunk)
+        else:
+            self.accumulator = None
         self.completion_start_time = None
         self.request_end_time = None
 
@@ -68,26 +81,46 @@ class LoggingStreamingResponse(Response):
             }
         )
         async for chunk in self.body_iterator:
+            if self.tracker is not None:
+                self.tracker.first_byte()
             if not isinstance(chunk, bytes):
                 chunk = chunk.encode(self.charset)
             if self.log_level >= 2:
                 self.logger.debug(f"Stream chunk: {chunk}")
-            self.response_chunks.append(chunk.decode(self.charset))
+            if self.accumulator is not None:
+                chunk = self.accumulator.feed(chunk)
+                if not chunk:
+                    continue
             await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        if self.accumulator is not None:
+            chunk = self.accumulator.flush()
+            if chunk:
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
 
         await send({"type": "http.response.body", "body": b"", "more_body": False})
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        async with anyio.create_task_group() as task_group:
-
-            async def wrap(func: "typing.Callable[[], typing.Awaitable[None]]") -> None:
-                await func()
-                task_group.cancel_scope.cancel()
-
-            task_group.start_soon(wrap, partial(self.stream_response, send))
-            await wrap(partial(self.listen_for_disconnect, receive))
+        try:
+            async with anyio.create_task_group() as task_group:
+
+                async def wrap(
+                    func: "typing.Callable[[], typing.Awaitable[None]]",
+                ) -> None:
+                    await func()
+                    task_group.cancel_scope.cancel()
+
+                task_group.start_soon(wrap, partial(self.stream_response, send))
+                await wrap(partial(self.listen_for_disconnect, receive))
+        except BaseException:
+            if self.tracker is not None:
+                self.tracker.finish(error=True)
+            raise
 
         self.request_end_time = datetime.now(timezone.utc)
+        if self.tracker is not None:
+            self.tracker.finish(error=self.status_code >= 500)
 
         if self.background is not None:
             await self.background()
@@ -95,25 +128,26 @@ class LoggingStreamingResponse(Response):
         await self.log_response()
 
     async def log_response(self):
-        if (
-            self.logging_call is not None
-            or self.observability_call is not None
-            or self.log_level > 0
-        ):
+        if self.accumulator is not None:
             try:
-                m = merge_response_chunks(
-                    self.response_chunks, object_type=self.object_type
-                )
+                m = self.accumulator.result()
             except Exception:
                 self.logger.warning("Failed to merge response chunks")
                 log_exception()
                 return
 
-            if "usage" in m and isinstance(self.prompt_tokens, int):
-                m["usage"]["prompt_tokens"] = self.prompt_tokens
-                m["usage"]["total_tokens"] = (
-                    m["usage"]["completion_tokens"] + self.prompt_tokens
-                )
+            if (
+                m["stream_merge_successful"]
+                and "prompt_tokens" not in m.get("usage", {})
+                and self.usage_fallback is not None
+            ):
+                # The upstream sent no usage chunk, count the tokens locally
+                try:
+                    m["usage"] = await run_in_threadpool(self.usage_fallback, m)
+                except Exception:
+                    log_exception()
+            if self.tracker is not None:
+                self.tracker.record_response(m)
             if self.logger:
                 self.logger.debug(f"Stream response: {m}")
             if self.logging_call:
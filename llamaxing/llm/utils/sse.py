@@ -0,0 +1,253 @@
+import re
+
+import json_codec
+
+_EVENT_BOUNDARY = re.compile(rb"\r?\n\r?\n")
+
+# Events are accumulated until their terminating blank line; anything larger
+# than this without one is treated as a broken stream.
+MAX_EVENT_SIZE = 4 * 1024 * 1024
+
+
+class StreamAccumulator:
+    """Incrementally merges an OpenAI style SSE stream into a single response.
+
+    Bytes are fed as they arrive and only complete events are decoded, so the
+    work per chunk is proportional to its size and only the merged message
+    state is kept. Supports multiple choices, tool call deltas and the usage
+    chunk sent with stream_options.include_usage.
+
+    With drop_usage_chunk, feed returns the bytes to forward to the client
+    with the usage chunk removed, holding back incomplete events. Whatever is
+    held back when the stream ends is returned by flush.
+    """
+
+    def __init__(
+        self, object_type: str = "chat.completion.chunk", drop_usage_chunk=False
+    ):
+        if object_type not in ("chat.completion.chunk", "text_completion"):
+            raise ValueError("Invalid object type")
+        self.object_type = object_type
+        self.drop_usage_chunk = drop_usage_chunk
+        self.buffer = bytearray()
+        self.scan_from = 0
+        self.response = None
+        self.choices = {}
+        self.usage = None
+        self.content_chunks = 0
+        self.done = False
+        self.failed = False
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self.done or self.failed:
+            return chunk
+        self.buffer += chunk
+        forward = [] if self.drop_usage_chunk else None
+        start = 0
+        while True:
+            match = _EVENT_BOUNDARY.search(self.buffer, self.scan_from)
+            if match is None:
+                break
+            keep = self.handle_event(bytes(self.buffer[start : match.start()]))
+            if forward is not None and keep:
+                forward.append(bytes(self.buffer[start : match.end()]))
+            start = self.scan_from = match.end()
+            if self.done or self.failed:
+                break
+        if self.done or self.failed or len(self.buffer) - start > MAX_EVENT_SIZE:
+            # Stop parsing and pass the rest of the stream through untouched
+            self.failed = self.failed or not self.done
+            if forward is not None:
+                forward.append(bytes(self.buffer[start:]))
+            self.buffer.clear()
+        else:
+            if start:
+                del self.buffer[:start]
+            # A boundary may straddle the next chunk, so rescan the last 3 bytes
+            self.scan_from = max(0, len(self.buffer) - 3)
+        return chunk if forward is None else b"".join(forward)
+
+    def flush(self) -> bytes:
+        """Handle an event left unterminated at the end of the stream,
+        returning the bytes still to forward."""
+        rest = bytes(self.buffer)
+        self.buffer.clear()
+        self.scan_from = 0
+        if not rest:
+            return b""
+        keep = self.handle_event(rest)
+        if not self.drop_usage_chunk:
+            # Already forwarded by feed
+            return b""
+        return rest if keep else b""
+
+    def handle_event(self, event: bytes) -> bool:
+        """Merge an event, returning whether it should be forwarded."""
+        data = [
+            line[5:].removeprefix(b" ")
+            for line in event.splitlines()
+            if line.startswith(b"data:")
+        ]
+        if not data:
+            # Comments and other fields carry nothing we need
+            return True
+        data = b"\n".join(data)
+        if data.strip() == b"[DONE]":
+            self.done = True
+            return True
+        try:
+            chunk = json_codec.loads(data)
+        except ValueError:
+            self.failed = True
+            return True
+        if not isinstance(chunk, dict) or chunk.get("object") != self.object_type:
+            return True
+        self.merge(chunk)
+        return not (
+            self.drop_usage_chunk and chunk.get("usage") and not chunk.get("choices")
+        )
+
+    def merge(self, chunk: dict) -> None:
+        if self.response is None:
+            self.response = {
+                k: v for k, v in chunk.items() if k not in ("choices", "usage")
+            }
+        if chunk.get("usage"):
+            self.usage = chunk["usage"]
+        for choice in chunk.get("choices") or []:
+            index = choice.get("index", 0)
+            merged = self.choices.get(index)
+            if merged is None:
+                merged = self.choices[index] = {
+                    "index": index,
+                    "parts": [],
+                    "tool_calls": {},
+                    "function_call": None,
+                    "extra": {},
+                    "finish_reason": None,
+                }
+            if choice.get("finish_reason") is not None:
+                merged["finish_reason"] = choice["finish_reason"]
+            if self.object_type == "text_completion":
+                if choice.get("text"):
+                    merged["parts"].append(choice["text"])
+                    self.content_chunks += 1
+                continue
+            delta = choice.get("delta") or {}
+            if delta.get("content"):
+                merged["parts"].append(delta["content"])
+                self.content_chunks += 1
+            for tool_call in delta.get("tool_calls") or []:
+                self.merge_tool_call(merged["tool_calls"], tool_call)
+            if delta.get("function_call"):
+                if merged["function_call"] is None:
+                    merged["function_call"] = {"name": "", "arguments": []}
+                function_call = delta["function_call"]
+                merged["function_call"]["name"] += function_call.get("name") or ""
+                merged["function_call"]["arguments"].append(
+                    function_call.get("arguments") or ""
+                )
+            for key, value in delta.items():
+                if (
+                    key not in ("content", "tool_calls", "function_call")
+                    and value is not None
+                ):
+                    merged["extra"][key] = value
+
+    @staticmethod
+    def merge_tool_call(tool_calls: dict, delta: dict) -> None:
+        tool_call = tool_calls.get(delta.get("index", 0))
+        if tool_call is None:
+            tool_call = tool_calls[delta.get("index", 0)] = {
+                "id": None,
+                "type": "function",
+                "name": "",
+                "arguments": [],
+            }
+        if delta.get("id"):
+            tool_call["id"] = delta["id"]
+        if delta.get("type"):
+            tool_call["type"] = delta["type"]
+        function = delta.get("function") or {}
+        tool_call["name"] += function.get("name") or ""
+        tool_call["arguments"].append(function.get("arguments") or "")
+
+    def result(self) -> dict:
+        """Return the merged response in the shape of a non-streaming one."""
+        if self.response is None:
+            raise ValueError("Merge failed - did not find any valid chunks!")
+        response = dict(self.response)
+        response["choices"] = [
+            self.build_choice(self.choices[index]) for index in sorted(self.choices)
+        ]
+        merge_successful = self.done and not self.failed
+        if self.usage is not None:
+            response["usage"] = self.usage
+        elif merge_successful:
+            response["usage"] = {"completion_tokens": self.content_chunks}
+        response["streaming_response"] = True
+        response["stream_merge_successful"] = merge_successful
+        return response
+
+    def build_choice(self, merged: dict) -> dict:
+        choice = {"index": merged["index"]}
+        if self.object_type == "text_completion":
+            choice["text"] = "".join(merged["parts"])
+        else:
+            message = dict(merged["extra"])
+            message["content"] = "".join(merged["parts"])
+            if merged["tool_calls"]:
+                message["tool_calls"] = [
+                    {
+                        "index": index,
+                        "id": x["id"],
+                        "type": x["type"],
+                        "function": {
+                            "name": x["name"],
+                            "arguments": "".join(x["arguments"]),
+                        },
+                    }
+                    for index, x in sorted(merged["tool_calls"].items())
+                ]
+            if merged["function_call"] is not None:
+                message["function_call"] = {
+                    "name": merged["function_call"]["name"],
+                    "arguments": "".join(merged["function_call"]["arguments"]),
+                }
+            choice["message"] = message
+        choice["finish_reason"] = merged["finish_reason"]
+        return choice
+
+
+def replay_stream(response: dict, include_usage: bool = False) -> bytes:
+    """Render a chat or text completion as the SSE stream an upstream would send."""
+    chat = response.get("object") == "chat.completion"
+    base = {
+        k: response[k]
+        for k in ("id", "created", "model", "system_fingerprint")
+        if k in response
+    }
+    base["object"] = "chat.completion.chunk" if chat else "text_completion"
+    events = []
+    for choice in response.get("choices") or []:
+        if chat:
+            delta = dict(choice.get("message") or {})
+            if "tool_calls" in delta:
+                delta["tool_calls"] = [
+                    {"index": i, **x} for i, x in enumerate(delta["tool_calls"])
+                ]
+            chunk_choice = {"index": choice.get("index", 0), "delta": delta}
+        else:
+            chunk_choice = {
+                "index": choice.get("index", 0),
+                "text": choice.get("text") or "",
+                "logprobs": choice.get("logprobs"),
+            }
+        chunk_choice["finish_reason"] = choice.get("finish_reason")
+        events.append({**base, "choices": [chunk_choice]})
+    if include_usage and response.get("usage"):
+        events.append({**base, "choices": [], "usage": response["usage"]})
+    return (
+        b"".join(b"data: " + json_codec.dumps(x) + b"\n\n" for x in events)
+        + b"data: [DONE]\n\n"
+    )
@@ -1,19 +1,36 @@
 import copy
-import json
+from collections.abc import Callable
 from datetime import datetime, timezone
 from functools import partial
+from time import perf_counter
 
+import json_codec
 from httpx import AsyncClient
+from httpx import Response as HTTPXResponse
 from identity import Identity
+from llm.batching import EmbeddingBatcher
+from llm.instance import RequestTracker
 from llm.logging import LoggingClientInterface
-from llm.utils.openai import num_tokens_from_messages, num_tokens_from_string
+from llm.utils.body import (
+    RequestBody,
+    decode_body,
+    encode_body,
+    request_stream_usage,
+    split_observation_metadata,
+)
+from llm.utils.openai import estimate_stream_usage
 from llm.utils.responses import LoggingStreamingResponse
 from logging_utils import log_exception, logger
 from nested_lookup import nested_alter
 from observability import ObservabilityClientInterface
 from settings import settings
-from starlette.background import BackgroundTask, BackgroundTasks
-from starlette.responses import JSONResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+from timings import request_timings
+
+# Bodies larger than this are parsed in a worker thread
+THREADED_PARSE_THRESHOLD = 1 << 20
 
 
 def trim_url(url: str):
@@ -31,6 +48,179 @@ def trim_data(data: dict):
     return trimmed_data
 
 
+def trim_embeddings(data: dict):
+    trimmed_data = copy.deepcopy(data)
+    for d in trimmed_data.get("data", []):
+        d["embedding"] = d["embedding"][:5]
+    return trimmed_data
+
+
+def bind_request(call: Callable, request, trim: Callable = None, **kwargs):
+    # Raw bodies are decoded when the call runs, after the response was sent
+    if not isinstance(request, RequestBody):
+        return partial(call, request=request, **kwargs)
+
+    async def deferred_call(**call_kwargs):
+        decoded = decode_body(request)
+        await call(
+            request=trim(decoded) if trim is not None else decoded,
+            **kwargs,
+            **call_kwargs,
+        )
+
+    return deferred_call
+
+
+def bind_logging_call(
+    logging_client: LoggingClientInterface,
+    request,
+    identity: Identity,
+    tracker: RequestTracker = None,
+    trim: Callable = None,
+    cache: str | None = None,
+    **kwargs,
+):
+    call = bind_request(logging_client.log_api_call, request, trim, **kwargs)
+
+    async def logging_call(response):
+        # The upstream request has finished by the time the response is logged
+        metadata = {"caller": identity.model_dump()}
+        if tracker is not None:
+            metadata.update(tracker.log_metadata())
+        if cache is not None:
+            metadata["cache"] = cache
+        await call(response=response, metadata=metadata)
+
+    return logging_call
+
+
+def bind_observability_call(
+    call: Callable,
+    request,
+    trim: Callable = None,
+    tracker: RequestTracker = None,
+    cache: str | None = None,
+    **kwargs,
+):
+    call = bind_request(call, request, trim, **kwargs)
+    timings = request_timings.get()
+
+    async def observability_call(**call_kwargs):
+        observed = dict(timings) if timings is not None else {}
+        if tracker is not None:
+            observed.update(tracker.log_metadata(), upstream_start=tracker.start_time)
+        if cache is not None:
+            observed["cache"] = cache
+        observed["observed"] = perf_counter()
+        await call(timings=observed, **call_kwargs)
+
+    return observability_call
+
+
+async def process_response(
+    content: bytes,
+    description: str,
+    end_time: datetime,
+    logging_call: Callable = None,
+    observability_call: Callable = None,
+    tracker: RequestTracker = None,
+    trim: Callable = None,
+    debug_trim: Callable = None,
+):
+    try:
+        if len(content) > THREADED_PARSE_THRESHOLD:
+            response = await run_in_threadpool(json_codec.loads, content)
+        else:
+            response = json_codec.loads(content)
+    except ValueError:
+        log_exception()
+        return
+    if tracker is not None and isinstance(response, dict):
+        tracker.record_response(response)
+    if trim is not None:
+        response = trim(response)
+    if settings.debug_level > 0:
+        debug_response = debug_trim(response) if debug_trim is not None else response
+        logger.debug(f"{description} response: {debug_response}")
+    if logging_call is not None:
+        await logging_call(response=response)
+    if observability_call is not None:
+        await observability_call(response=response, end_time=end_time)
+
+
+def passthrough_response(r: HTTPXResponse, description: str, **kwargs) -> Response:
+    """Forward the upstream body as-is; parsing is deferred until it has been sent"""
+    end_time = datetime.now(timezone.utc)
+    needs_parsing = settings.debug_level > 0 or any(
+        kwargs.get(k) is not None
+        for k in ("logging_call", "observability_call", "tracker")
+    )
+    if needs_parsing:
+        background = BackgroundTask(
+            process_response, r.content, description, end_time, **kwargs
+        )
+    else:
+        background = None
+    return Response(
+        r.content,
+        status_code=r.status_code,
+        media_type=r.headers.get("content-type", "application/json"),
+        background=background,
+    )
+
+
+def cache_hit_response(
+    response: Response,
+    content: bytes,
+    endpoint: str,
+    data: dict,
+    identity: Identity,
+    logging_client: LoggingClientInterface = None,
+    observability_client: ObservabilityClientInterface = None,
+) -> Response:
+    """Log and observe a response served from the cache, marked as a hit.
+
+    The content is the cached response in its non-streaming shape.
+    """
+    if logging_client is None and observability_client is None:
+        return response
+    start_time = datetime.now(timezone.utc)
+    data, observation_metadata = split_observation_metadata(data)
+    trim = None if endpoint == "embeddings" else trim_data
+    if trim is not None and not isinstance(data, RequestBody):
+        data = trim(data)
+
+    if logging_client is not None:
+        logging_call = bind_logging_call(
+            logging_client, data, identity, trim=trim, cache="HIT", endpoint=endpoint
+        )
+    else:
+        logging_call = None
+    if observability_client is not None:
+        observability_call = bind_observability_call(
+            getattr(observability_client, endpoint),
+            data,
+            trim,
+            cache="HIT",
+            identity=identity,
+            metadata={**(observation_metadata or {}), "cache": "HIT"},
+            start_time=start_time,
+        )
+    else:
+        observability_call = None
+    response.background = BackgroundTask(
+        process_response,
+        content,
+        "Cached response",
+        datetime.now(timezone.utc),
+        logging_call=logging_call,
+        observability_call=observability_call,
+        trim=trim,
+        debug_trim=trim_embeddings if endpoint == "embeddings" else None,
+    )
+    return response
+
+
 async def chat_completions_wrapper(
     data: dict,
     url: str,
@@ -40,73 +230,77 @@ async def chat_completions_wrapper(
     logging_client: LoggingClientInterface = None,
     observability_client: ObservabilityClientInterface = None,
     sidecar_mode: bool = False,
+    tracker: RequestTracker = None,
+    include_usage: bool = False,
 ):
-    trimmed_request = trim_data(data)
+    trimmed_request = data if isinstance(data, RequestBody) else trim_data(data)
     logger.debug(f"Chat completion request: {trimmed_request}")
     if not sidecar_mode:
         request_start_time = datetime.now(timezone.utc)
-        observation_metadata = data.pop("observation_metadata", None)
-
-    request = requests_client.build_request(
-        "POST", url, headers=headers, data=json.dumps(data)
-    )
+        # Leave the caller's data untouched so the request can be retried
+        data, observation_metadata = split_observation_metadata(data)
 
     if logging_client is not None:
-        logging_call = partial(
-            logging_client.log_api_call,
+        logging_call = bind_logging_call(
+            logging_client,
+            trimmed_request,
+            identity,
+            tracker,
+            trim_data,
             endpoint="chat_completions",
-            metadata={"caller": identity.model_dump()},
-            request=trimmed_request,
         )
     else:
         logging_call = None
     if observability_client is not None:
-        observability_call = partial(
+        observability_call = bind_observability_call(
             observability_client.chat_completions,
+            trimmed_request,
+            trim_data,
             identity=identity,
+            tracker=tracker,
             metadata=observation_metadata,
-            request=trimmed_request,
             start_time=request_start_time,
         )
     else:
         observability_call = None
 
-    if "stream" in data and data["stream"] is True:
-        try:
-            prompt_tokens = num_tokens_from_messages(data["messages"], data["model"])
-        except Exception:
-            log_exception()
-            prompt_tokens = None
+    stream = data.get("stream") is True
+    drop_usage_chunk = False
+    if stream and include_usage:
+        data, drop_usage_chunk = request_stream_usage(data)
+    request = requests_client.build_request(
+        "POST", url, headers=headers, content=encode_body(data)
+    )
+
+    if stream:
         r = await requests_client.send(request, stream=True)
+        if tracker is not None:
+            await tracker.on_response(r, stream=True)
         return LoggingStreamingResponse(
             r.aiter_raw(),
             status_code=r.status_code,
             headers=r.headers,
             background=BackgroundTask(r.aclose),
             logger=logger,
-            prompt_tokens=prompt_tokens,
+            usage_fallback=lambda m: estimate_stream_usage(decode_body(data), m),
+            drop_usage_chunk=drop_usage_chunk,
             object_type="chat.completion.chunk",
             logging_call=logging_call,
             observability_call=observability_call,
+            tracker=tracker,
         )
     else:
         r = await requests_client.send(request)
-        response = r.json()
-        trimmed_response = trim_data(response)
-        request_end_time = datetime.now(timezone.utc)
-        logger.debug(f"Chat completion response: {trimmed_response}")
-        background_tasks = BackgroundTasks()
-        if observability_client is not None:
-            background_tasks.add_task(
-                partial(
-                    observability_call,
-                    response=trimmed_response,
-                    end_time=request_end_time,
-                )
-            )
-        if logging_client is not None:
-            background_tasks.add_task(partial(logging_call, response=trimmed_response))
-        return JSONResponse(response, background=background_tasks)
+        if tracker is not None:
+            await tracker.on_response(r)
+        return passthrough_response(
+            r,
+            "Chat completion",
+            logging_call=logging_call,
+            observability_call=observability_call,
+            tracker=tracker,
+            trim=trim_data,
+        )
 
 
 async def completions_wrapper(
@@ -118,65 +312,68 @@ async def completions_wrapper(
     logging_client: LoggingClientInterface = None,
     observability_client: ObservabilityClientInterface = None,
     sidecar_mode: bool = False,
+    tracker: RequestTracker = None,
+    include_usage: bool = False,
 ):
     logger.debug(f"Completion request: {data}")
     if not sidecar_mode:
         request_start_time = datetime.now(timezone.utc)
-        observation_metadata = data.pop("observation_metadata", None)
-
-    request = requests_client.build_request(
-        "POST", url, headers=headers, data=json.dumps(data)
-    )
+        data, observation_metadata = split_observation_metadata(data)
 
     if logging_client is not None:
-        logging_call = partial(
-            logging_client.log_api_call,
-            endpoint="completions",
-            metadata={"caller": identity.model_dump()},
-            request=data,
+        logging_call = bind_logging_call(
+            logging_client, data, identity, tracker, endpoint="completions"
         )
     else:
         logging_call = None
     if observability_client is not None:
-        observability_call = partial(
+        observability_call = bind_observability_call(
             observability_client.completions,
+            data,
             identity=identity,
+            tracker=tracker,
             metadata=observation_metadata,
-            request=data,
             start_time=request_start_time,
         )
     else:
         observability_call = None
 
-    if "stream" in data and data["stream"] is True:
-        prompt_tokens = num_tokens_from_string(data["prompt"], data["model"])
+    stream = data.get("stream") is True
+    drop_usage_chunk = False
+    if stream and include_usage:
+        data, drop_usage_chunk = request_stream_usage(data)
+    request = requests_client.build_request(
+        "POST", url, headers=headers, content=encode_body(data)
+    )
+
+    if stream:
         r = await requests_client.send(request, stream=True)
+        if tracker is not None:
+            await tracker.on_response(r, stream=True)
         return LoggingStreamingResponse(
             r.aiter_raw(),
             status_code=r.status_code,
             headers=r.headers,
             background=BackgroundTask(r.aclose),
             logger=logger,
-            prompt_tokens=prompt_tokens,
+            usage_fallback=lambda m: estimate_stream_usage(decode_body(data), m),
+            drop_usage_chunk=drop_usage_chunk,
             object_type="text_completion",
             logging_call=logging_call,
             observability_call=observability_call,
+            tracker=tracker,
         )
     else:
         r = await requests_client.send(request)
-        response = r.json()
-        request_end_time = datetime.now(timezone.utc)
-        logger.debug(f"Completion response: {response}")
-        background_tasks = BackgroundTasks()
-        if observability_client is not None:
-            background_tasks.add_task(
-                partial(
-                    observability_call, response=response, end_time=request_end_time
-                )
-            )
-        if logging_client is not None:
-            background_tasks.add_task(partial(logging_call, response=response))
-        return JSONResponse(response, background=background_tasks)
+        if tracker is not None:
+            await tracker.on_response(r)
+        return passthrough_response(
+            r,
+            "Completion",
+            logging_call=logging_call,
+            observability_call=observability_call,
+            tracker=tracker,
+        )
 
 
 async def embeddings_wrapper(
@@ -188,48 +385,49 @@ async def embeddings_wrapper(
     logging_client: LoggingClientInterface = None,
     observability_client: ObservabilityClientInterface = None,
     sidecar_mode: bool = False,
+    tracker: RequestTracker = None,
+    batcher: EmbeddingBatcher = None,
 ):
     logger.debug(f"Embeddings request: {data}")
     if not sidecar_mode:
         request_start_time = datetime.now(timezone.utc)
-        observation_metadata = data.pop("observation_metadata", None)
-    response = await requests_client.post(
-        url,
-        data=json.dumps(data),
-        headers=headers,
-    )
-    response = response.json()
-    if settings.debug_level > 0:
-        trimmed_response = copy.deepcopy(response)
-        for d in trimmed_response["data"]:
-            d["embedding"] = d["embedding"][:5]
-        logger.debug(f"Embeddings response: {trimmed_response}")
-    request_end_time = datetime.now(timezone.utc)
+        data, observation_metadata = split_observation_metadata(data)
+    if batcher is not None:
+        r = await batcher.submit(decode_body(data), url, headers, requests_client)
+    else:
+        r = await requests_client.post(
+            url,
+            content=encode_body(data),
+            headers=headers,
+        )
+    if tracker is not None:
+        await tracker.on_response(r)
 
-    background_tasks = BackgroundTasks()
     if logging_client is not None:
-        background_tasks.add_task(
-            partial(
-                logging_client.log_api_call,
-                "embeddings",
-                {"caller": identity.model_dump()},
-                data,
-                response,
-            )
+        logging_call = bind_logging_call(
+            logging_client, data, identity, tracker, endpoint="embeddings"
         )
+    else:
+        logging_call = None
     if observability_client is not None:
-        background_tasks.add_task(
-            partial(
-                observability_client.embeddings,
-                identity=identity,
-                metadata=observation_metadata,
-                request=data,
-                start_time=request_start_time,
-                response=response,
-                end_time=request_end_time,
-            )
+        observability_call = bind_observability_call(
+            observability_client.embeddings,
+            data,
+            identity=identity,
+            tracker=tracker,
+            metadata=observation_metadata,
+            start_time=request_start_time,
         )
-    return JSONResponse(response, background=background_tasks)
+    else:
+        observability_call = None
+    return passthrough_response(
+        r,
+        "Embeddings",
+        logging_call=logging_call,
+        observability_call=observability_call,
+        tracker=tracker,
+        debug_trim=trim_embeddings,
+    )
 
 
 async def images_generations_wrapper(
@@ -241,42 +439,42 @@ async def images_generations_wrapper(
     logging_client: LoggingClientInterface = None,
     observability_client: ObservabilityClientInterface = None,
     sidecar_mode: bool = False,
+    tracker: RequestTracker = None,
 ):
     logger.debug(f"Images generations request: {data}")
     if not sidecar_mode:
         request_start_time = datetime.now(timezone.utc)
-        observation_metadata = data.pop("observation_metadata", None)
-    response = await requests_client.post(
+        data, observation_metadata = split_observation_metadata(data)
+    r = await requests_client.post(
         url,
-        data=json.dumps(data),
+        content=encode_body(data),
         headers=headers,
     )
-    response = response.json()
-    trimmed_response = trim_data(response)
-    logger.debug(f"Images generations response: {trimmed_response}")
-    request_end_time = datetime.now(timezone.utc)
+    if tracker is not None:
+        await tracker.on_response(r)
 
-    background_tasks = BackgroundTasks()
     if logging_client is not None:
-        background_tasks.add_task(
-            partial(
-                logging_client.log_api_call,
-                "images_generations",
-                {"caller": identity.model_dump()},
-                data,
-                trimmed_response,
-            )
+        logging_call = bind_logging_call(
+            logging_client, data, identity, tracker, endpoint="images_generations"
         )
+    else:
+        logging_call = None
     if observability_client is not None:
-        background_tasks.add_task(
-            partial(
-                observability_client.images_generations,
-                identity=identity,
-                metadata=observation_metadata,
-                request=data,
-                start_time=request_start_time,
-                response=trimmed_response,
-                end_time=request_end_time,
-            )
+        observability_call = bind_observability_call(
+            observability_client.images_generations,
+            data,
+            identity=identity,
+            tracker=tracker,
+            metadata=observation_metadata,
+            start_time=request_start_time,
         )
-    return JSONResponse(response, background=background_tasks)
+    else:
+        observability_call = None
+    return passthrough_response(
+        r,
+        "Images generations",
+        logging_call=logging_call,
+        observability_call=observability_call,
+        tracker=tracker,
+        trim=trim_data,
+    )
@@ -1,29 +1,59 @@
+import asyncio
+import math
 from contextlib import asynccontextmanager
+from functools import partial
 from importlib import import_module
 from typing import Annotated
 
 import httpx
+import json_codec
+import timings
 import version
+from config_reload import ConfigReloader
 from fastapi import Depends, FastAPI, HTTPException, Request
+from http_client import build_client
 from identity import Identity
 from llm import LLMDispatcher
+from llm.routing import default_http_options
+from llm.utils.body import read_request
 from logging_utils import log_exception, logger
 from settings import settings
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.requests_client = httpx.AsyncClient(timeout=settings.app_requests_timeout)
+    app.requests_client, app.pool_stats = build_client(default_http_options())
     logging_module = import_module(f"llm.logging.{settings.logging_client}")
     app.logging_client = logging_module.LoggingClient()
+    await app.logging_client.on_startup()
     observability_module = import_module(
         f"observability.{settings.observability_client}"
     )
     app.observability_client = observability_module.ObservabilityClient()
+    app.observability_client.on_startup()
+    rate_limiter_module = import_module(f"ratelimit.{settings.rate_limiter}")
+    app.rate_limiter = rate_limiter_module.RateLimiter()
+    response_cache_module = import_module(f"llm.cache.{settings.response_cache}")
+    app.response_cache = response_cache_module.ResponseCache()
+    app.config_reloader = ConfigReloader(
+        {
+            "models.json": llm_dispatcher.reload_models,
+            settings.identity_store_json_filename: partial(
+                asyncio.to_thread, identity_store.reload
+            ),
+        },
+        settings.app_config_reload_interval,
+    )
+    app.config_reloader.on_startup()
+    await asyncio.to_thread(llm_dispatcher.warm_up_tokenizers)
     yield
+    await app.config_reloader.on_shutdown()
     await app.requests_client.aclose()
     await app.logging_client.on_shutdown()
     await app.observability_client.on_shutdown()
+    await app.rate_limiter.on_shutdown()
+    await llm_dispatcher.on_shutdown()
+    await app.response_cache.on_shutdown()
 
 
 if settings.auth_method == "none":
@@ -35,7 +65,9 @@ app = FastAPI(
     version=version.__version__,
     docs_url="/",
     redoc_url=None,
+    default_response_class=json_codec.CodecJSONResponse,
 )
+app.add_middleware(timings.TimingMiddleware)
 
 identity_store_module = import_module(f"identity.store.{settings.identity_store}")
 identity_store = identity_store_module.IdentityStore()
@@ -45,13 +77,37 @@ auth_handler = auth_module.AuthHandler(identity_store)
 llm_dispatcher = LLMDispatcher()
 
 
+async def rate_limit(
+    request: Request, identity: Annotated[Identity, Depends(auth_handler)]
+):
+    timings.mark("authenticated")
+    retry_after = await request.app.rate_limiter.check(identity)
+    if retry_after is not None:
+        raise HTTPException(
+            429,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    timings.mark("admitted")
+    return identity
+
+
+def response_cache(request: Request, identity: Identity):
+    if settings.response_cache == "none" or not identity.response_cache:
+        return None
+    cache_control = request.headers.get("cache-control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return None
+    return request.app.response_cache
+
+
 @app.post("/chat/completions")
 @app.post("/v1/chat/completions")
 async def chat_completions(
-    request: Request, identity: Annotated[Identity, Depends(auth_handler)]
+    request: Request, identity: Annotated[Identity, Depends(rate_limit)]
 ):
     try:
-        data = await request.json()
+        data = await read_request(request, settings.app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -64,9 +120,15 @@ async def chat_completions(
             request.app.requests_client,
             request.app.logging_client,
             request.app.observability_client,
+            request.app.rate_limiter,
+            response_cache(request, identity),
         )
+    except HTTPException:
+        raise
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -75,10 +137,10 @@ async def chat_completions(
 @app.post("/completions")
 @app.post("/v1/completions")
 async def completions(
-    request: Request, identity: Annotated[Identity, Depends(auth_handler)]
+    request: Request, identity: Annotated[Identity, Depends(rate_limit)]
 ):
     try:
-        data = await request.json()
+        data = await read_request(request, settings.app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -91,9 +153,15 @@ async def completions(
             request.app.requests_client,
             request.app.logging_client,
             request.app.observability_client,
+            request.app.rate_limiter,
+            response_cache(request, identity),
         )
+    except HTTPException:
+        raise
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -102,10 +170,10 @@ async def completions(
 @app.post("/embeddings")
 @app.post("/v1/embeddings")
 async def embeddings(
-    request: Request, identity: Annotated[Identity, Depends(auth_handler)]
+    request: Request, identity: Annotated[Identity, Depends(rate_limit)]
 ):
     try:
-        data = await request.json()
+        data = await read_request(request, settings.app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -118,9 +186,15 @@ async def embeddings(
             request.app.requests_client,
             request.app.logging_client,
             request.app.observability_client,
+            request.app.rate_limiter,
+            response_cache(request, identity),
         )
+    except HTTPException:
+        raise
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -129,10 +203,10 @@ async def embeddings(
 @app.post("/images/generations")
 @app.post("/v1/images/generations")
 async def images_generations(
-    request: Request, identity: Annotated[Identity, Depends(auth_handler)]
+    request: Request, identity: Annotated[Identity, Depends(rate_limit)]
 ):
     try:
-        data = await request.json()
+        data = await read_request(request, settings.app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -145,9 +219,15 @@ async def images_generations(
             request.app.requests_client,
             request.app.logging_client,
             request.app.observability_client,
+            request.app.rate_limiter,
+            response_cache(request, identity),
         )
+    except HTTPException:
+        raise
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -158,13 +238,51 @@ async def images_generations(
 async def models(identity: Annotated[Identity, Depends(auth_handler)]):
     try:
         return llm_dispatcher.get_models()
+    except HTTPException:
+        raise
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
 
 
+def admin(identity: Annotated[Identity, Depends(auth_handler)]):
+    if not settings.app_admin_endpoints:
+        raise HTTPException(404)
+    # Without authentication everybody is the same anonymous identity
+    if settings.auth_method != "none" and not identity.admin:
+        raise HTTPException(403)
+    return identity
+
+
+@app.get("/admin/instances")
+async def admin_instances(
+    request: Request, identity: Annotated[Identity, Depends(admin)]
+):
+    # Instances without HTTP options of their own use the shared pool
+    return {
+        **llm_dispatcher.get_instances(),
+        "http_pool": request.app.pool_stats.to_dict(),
+    }
+
+
+@app.get("/admin/logging")
+async def admin_logging(
+    request: Request, identity: Annotated[Identity, Depends(admin)]
+):
+    return request.app.logging_client.get_stats()
+
+
+@app.get("/admin/observability")
+async def admin_observability(
+    request: Request, identity: Annotated[Identity, Depends(admin)]
+):
+    return request.app.observability_client.get_stats()
+
+
 if __name__ == "__main__":
     import uvicorn
 
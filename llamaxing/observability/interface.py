@@ -13,6 +13,9 @@ class ObservabilityClientInterface(ABC):
     async def on_shutdown(self):
         pass
 
+    def get_stats(self) -> dict | None:
+        return None
+
     @abstractmethod
     async def completions(
         self,
@@ -23,6 +26,7 @@ class ObservabilityClientInterface(ABC):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         pass
 
@@ -36,6 +40,7 @@ class ObservabilityClientInterface(ABC):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         pass
 
@@ -49,6 +54,7 @@ class ObservabilityClientInterface(ABC):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         pass
 
@@ -62,5 +68,6 @@ class ObservabilityClientInterface(ABC):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         pass
@@ -1,33 +1,152 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from time import monotonic
 from uuid import uuid4
 
 import pydash
 from identity import Identity
 from langfuse import Langfuse
-from logging_utils import log_exception
+from logging_utils import log_exception, logger
 from observability.interface import ObservabilityClientInterface
 from settings import settings
 
+# Events sent to Langfuse in one go by the worker
+BATCH_SIZE = 64
+
 
 class ObservabilityClient(ObservabilityClientInterface):
+    """Sends traces to Langfuse from a single worker thread.
+
+    The Langfuse SDK is synchronous, so events are put on a bounded queue and
+    handed in batches to a one thread executor, keeping SDK calls off the
+    event loop. When the queue is full, events wait up to
+    observability_client_langfuse_enqueue_timeout seconds for room before
+    being dropped. Langfuse clients, one per identity, are kept in an LRU
+    cache of observability_client_langfuse_max_clients.
+    """
+
     def __init__(self) -> None:
-        self.langfuse_clients = {}
+        self.langfuse_clients: OrderedDict[tuple, Langfuse] = OrderedDict()
+        self.clients_lock = threading.Lock()
+        self.queue = asyncio.Queue(settings.observability_client_langfuse_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="langfuse")
+        self.task = None
+        self.stats = {"queued": 0, "sent": 0, "failed": 0, "dropped": 0}
 
-    def get_langfuse_client(self, identity: Identity):
-        if identity.id not in self.langfuse_clients:
-            self.langfuse_clients[identity.id] = Langfuse(
+    def get_langfuse_client(self, key: tuple) -> Langfuse:
+        identity_id, public_key, secret_key = key
+        with self.clients_lock:
+            client = self.langfuse_clients.get(key)
+            if client is not None:
+                self.langfuse_clients.move_to_end(key)
+                return client
+            client = self.langfuse_clients[key] = Langfuse(
                 host=settings.observability_client_langfuse_host,
-                public_key=identity.observability.langfuse_public_key.get_secret_value(),  # noqa E501
-                secret_key=identity.observability.langfuse_secret_key.get_secret_value(),  # noqa E501
+                public_key=public_key,
+                secret_key=secret_key,
             )
-        return self.langfuse_clients[identity.id]
+            evicted = []
+            while (
+                len(self.langfuse_clients)
+                > settings.observability_client_langfuse_max_clients
+            ):
+                evicted.append(self.langfuse_clients.popitem(last=False)[1])
+        for x in evicted:
+            # Sends what the evicted client still has buffered
+            x.shutdown()
+        return client
 
     def on_startup(self):
-        pass
+        self.task = asyncio.create_task(self.run())
 
     async def on_shutdown(self):
-        for _, lc in self.langfuse_clients.items():
-            lc.flush()
+        deadline = monotonic() + settings.observability_client_langfuse_shutdown_timeout
+        if self.task is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), deadline - monotonic())
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"Dropping {self.queue.qsize()} Langfuse events on shutdown"
+                )
+            self.task.cancel()
+        try:
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.flush_clients
+                ),
+                max(0, deadline - monotonic()),
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out flushing Langfuse clients")
+        self.executor.shutdown(wait=False)
+
+    def flush_clients(self):
+        with self.clients_lock:
+            clients = list(self.langfuse_clients.values())
+        for x in clients:
+            x.flush()
+
+    def get_stats(self):
+        return {
+            **self.stats,
+            "queue_size": self.queue.qsize(),
+            "clients": len(self.langfuse_clients),
+        }
+
+    async def submit(self, identity: Identity, metadata: dict, **generation):
+        key = (
+            identity.id,
+            identity.observability.langfuse_public_key.get_secret_value(),
+            identity.observability.langfuse_secret_key.get_secret_value(),
+        )
+        trace = {
+            "id": metadata.pop("trace_id", str(uuid4())),
+            "name": metadata.pop("trace_name", None),
+            "tags": metadata.pop("trace_tags", None),
+            "metadata": metadata.pop("trace_metadata", None),
+            "user_id": identity.id,
+        }
+        generation = {
+            "id": metadata.pop("generation_id", str(uuid4())),
+            **generation,
+            "name": metadata.pop("name", None),
+            "status_message": metadata.pop("status_message", None),
+            "metadata": metadata,
+        }
+        try:
+            await asyncio.wait_for(
+                self.queue.put((key, trace, generation)),
+                settings.observability_client_langfuse_enqueue_timeout,
+            )
+            self.stats["queued"] += 1
+        except asyncio.TimeoutError:
+            self.stats["dropped"] += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            events = [await self.queue.get()]
+            while len(events) < BATCH_SIZE and not self.queue.empty():
+                events.append(self.queue.get_nowait())
+            try:
+                await loop.run_in_executor(self.executor, self.send, events)
+            except Exception:
+                log_exception()
+            finally:
+                for _ in events:
+                    self.queue.task_done()
+
+    def send(self, events: list[tuple]):
+        for key, trace, generation in events:
+            try:
+                self.get_langfuse_client(key).trace(**trace).generation(**generation)
+                self.stats["sent"] += 1
+            except Exception:
+                log_exception()
+                self.stats["failed"] += 1
 
     async def completions(
         self,
@@ -38,6 +157,7 @@ class ObservabilityClient(ObservabilityClientInterface):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         if identity.observability is not None:
             if metadata is None:
@@ -65,16 +185,9 @@ class ObservabilityClient(ObservabilityClientInterface):
             if response_format is not None:
                 model_params["response_format"] = response_format
             try:
-                langfuse = self.get_langfuse_client(identity)
-                trace = langfuse.trace(
-                    id=metadata.pop("trace_id", str(uuid4())),
-                    name=metadata.pop("trace_name", None),
-                    tags=metadata.pop("trace_tags", None),
-                    metadata=metadata.pop("trace_metadata", None),
-                    user_id=identity.id,
-                )
-                trace.generation(
-                    id=metadata.pop("generation_id", str(uuid4())),
+                await self.submit(
+                    identity,
+                    metadata,
                     start_time=start_time,
                     end_time=end_time,
                     completion_start_time=completion_start_time,
@@ -83,9 +196,6 @@ class ObservabilityClient(ObservabilityClientInterface):
                     input=request["messages"],
                     output=response["choices"][0]["message"],
                     usage=response["usage"],
-                    name=metadata.pop("name", None),
-                    status_message=metadata.pop("status_message", None),
-                    metadata=metadata,
                 )
             except Exception:
                 log_exception()
@@ -99,6 +209,7 @@ class ObservabilityClient(ObservabilityClientInterface):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         if identity.observability is not None:
             if metadata is None:
@@ -124,16 +235,9 @@ class ObservabilityClient(ObservabilityClientInterface):
             if response_format is not None:
                 model_params["response_format"] = response_format
             try:
-                langfuse = self.get_langfuse_client(identity)
-                trace = langfuse.trace(
-                    id=metadata.pop("trace_id", str(uuid4())),
-                    name=metadata.pop("trace_name", None),
-                    tags=metadata.pop("trace_tags", None),
-                    metadata=metadata.pop("trace_metadata", None),
-                    user_id=identity.id,
-                )
-                trace.generation(
-                    id=metadata.pop("generation_id", str(uuid4())),
+                await self.submit(
+                    identity,
+                    metadata,
                     start_time=start_time,
                     end_time=end_time,
                     completion_start_time=completion_start_time,
@@ -142,9 +246,6 @@ class ObservabilityClient(ObservabilityClientInterface):
                     input=request["messages"],
                     output=response["choices"][0]["message"],
                     usage=response.get("usage"),
-                    name=metadata.pop("name", None),
-                    status_message=metadata.pop("status_message", None),
-                    metadata=metadata,
                 )
             except Exception:
                 log_exception()
@@ -158,28 +259,23 @@ class ObservabilityClient(ObservabilityClientInterface):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         if identity.observability is not None:
             if metadata is None:
                 metadata = {}
             model_params_keys = [
-                "encoding_format" "dimensions",
+                "encoding_format",
+                "dimensions",
             ]
             model_params = {}
             for key in model_params_keys:
                 if key in request and request[key] is not None:
                     model_params[key] = request[key]
             try:
-                langfuse = self.get_langfuse_client(identity)
-                trace = langfuse.trace(
-                    id=metadata.pop("trace_id", str(uuid4())),
-                    name=metadata.pop("trace_name", None),
-                    tags=metadata.pop("trace_tags", None),
-                    metadata=metadata.pop("trace_metadata", None),
-                    user_id=identity.id,
-                )
-                trace.generation(
-                    id=metadata.pop("generation_id", str(uuid4())),
+                await self.submit(
+                    identity,
+                    metadata,
                     start_time=start_time,
                     end_time=end_time,
                     completion_start_time=completion_start_time,
@@ -187,9 +283,6 @@ class ObservabilityClient(ObservabilityClientInterface):
                     model_parameters=model_params,
                     input=request["input"],
                     usage=response["usage"],
-                    name=metadata.pop("name", None),
-                    status_message=metadata.pop("status_message", None),
-                    metadata=metadata,
                 )
             except Exception:
                 log_exception()
@@ -203,26 +296,20 @@ class ObservabilityClient(ObservabilityClientInterface):
         start_time: datetime,
         end_time: datetime,
         completion_start_time: datetime | None = None,
+        timings: dict | None = None,
     ):
         if identity.observability is not None:
             if metadata is None:
                 metadata = {}
-            model_params_keys = ["n" "quality", "response_format", "size", "style"]
+            model_params_keys = ["n", "quality", "response_format", "size", "style"]
             model_params = {}
             for key in model_params_keys:
                 if key in request and request[key] is not None:
                     model_params[key] = request[key]
             try:
-                langfuse = self.get_langfuse_client(identity)
-                trace = langfuse.trace(
-                    id=metadata.pop("trace_id", str(uuid4())),
-                    name=metadata.pop("trace_name", None),
-                    tags=metadata.pop("trace_tags", None),
-                    metadata=metadata.pop("trace_metadata", None),
-                    user_id=identity.id,
-                )
-                trace.generation(
-                    id=metadata.pop("generation_id", str(uuid4())),
+                await self.submit(
+                    identity,
+                    metadata,
                     start_time=start_time,
                     end_time=end_time,
                     completion_start_time=completion_start_time,
@@ -231,9 +318,6 @@ class ObservabilityClient(ObservabilityClientInterface):
                     input=request["prompt"],
                     output=response["data"],
                     usage={"total": len(response["data"]), "unit": "IMAGES"},
-                    name=metadata.pop("name", None),
-                    status_message=metadata.pop("status_message", None),
-                    metadata=metadata,
                 )
             except Exception:
                 log_exception()
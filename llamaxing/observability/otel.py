@@ -0,0 +1,310 @@
+import asyncio
+from datetime import datetime
+from time import perf_counter, time_ns
+
+from identity import Identity
+from logging_utils import log_exception
+from observability.interface import ObservabilityClientInterface
+from opentelemetry import trace
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import MetricReader, PeriodicExportingMetricReader
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter
+from settings import settings
+
+
+class ObservabilityClient(ObservabilityClientInterface):
+    """Exports a trace and metrics per API call with OpenTelemetry.
+
+    Calls are observed once the response has been handled, so spans are
+    built after the fact from the timings of the request: authentication,
+    rate limiting, dispatch, the upstream request (waiting for a pooled
+    connection, connecting, time to first byte and the rest of a stream)
+    and the background work up to this call. Spans and metrics are
+    exported over OTLP/HTTP in batches, unless an exporter or metric
+    reader is passed in, e.g. in-memory ones in tests.
+    """
+
+    def __init__(
+        self,
+        span_exporter: SpanExporter | None = None,
+        metric_reader: MetricReader | None = None,
+    ) -> None:
+        if span_exporter is None or metric_reader is None:
+            # Only needed when exporting to a collector
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import (
+                OTLPMetricExporter,
+            )
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+                OTLPSpanExporter,
+            )
+
+            endpoint = settings.observability_client_otel_endpoint.rstrip("/")
+            if span_exporter is None:
+                span_exporter = OTLPSpanExporter(endpoint=f"{endpoint}/v1/traces")
+            if metric_reader is None:
+                metric_reader = PeriodicExportingMetricReader(
+                    OTLPMetricExporter(endpoint=f"{endpoint}/v1/metrics"),
+                    export_interval_millis=(
+                        settings.observability_client_otel_metrics_interval * 1000
+                    ),
+                )
+        resource = Resource.create({"service.name": settings.app_name})
+        self.tracer_provider = TracerProvider(resource=resource)
+        self.tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+        self.meter_provider = MeterProvider(
+            resource=resource, metric_readers=[metric_reader]
+        )
+        self.tracer = self.tracer_provider.get_tracer("llamaxing")
+        meter = self.meter_provider.get_meter("llamaxing")
+        self.request_duration = meter.create_histogram(
+            "llamaxing.request.duration",
+            unit="s",
+            description="Time from receiving a request until it was observed",
+        )
+        self.upstream_duration = meter.create_histogram(
+            "llamaxing.upstream.duration",
+            unit="s",
+            description="Duration of upstream requests",
+        )
+        self.upstream_ttfb = meter.create_histogram(
+            "llamaxing.upstream.ttfb",
+            unit="s",
+            description="Time to first byte of upstream responses",
+        )
+        self.upstream_pool_wait = meter.create_histogram(
+            "llamaxing.upstream.pool_wait",
+            unit="s",
+            description="Time upstream requests waited for a pooled connection",
+        )
+        self.tokens = meter.create_histogram(
+            "llamaxing.tokens",
+            unit="{token}",
+            description="Tokens used per request",
+        )
+        self.upstream_responses = meter.create_counter(
+            "llamaxing.upstream.responses",
+            description="Upstream responses by status code",
+        )
+
+    def on_startup(self):
+        pass
+
+    async def on_shutdown(self):
+        # Both flush their exporters, which blocks on network I/O
+        await asyncio.to_thread(self.tracer_provider.shutdown)
+        await asyncio.to_thread(self.meter_provider.shutdown)
+
+    def observe(
+        self,
+        endpoint: str,
+        identity: Identity,
+        request: dict,
+        response: dict,
+        start_time: datetime,
+        end_time: datetime,
+        timings: dict | None,
+    ):
+        timings = timings or {}
+        # Marks are perf_counter values, convert them to epoch nanoseconds
+        now, now_ns = perf_counter(), time_ns()
+
+        def ns(mark: float) -> int:
+            return now_ns - int((now - mark) * 1e9)
+
+        usage = (response.get("usage") or {}) if isinstance(response, dict) else {}
+        attributes = {
+            "llamaxing.endpoint": endpoint,
+            "gen_ai.request.model": request.get("model") or "",
+        }
+        if timings.get("instance") is not None:
+            attributes["llamaxing.instance"] = timings["instance"]
+        if timings.get("status_code") is not None:
+            attributes["http.response.status_code"] = timings["status_code"]
+        if timings.get("cache") is not None:
+            attributes["llamaxing.cache"] = timings["cache"]
+
+        observed = timings.get("observed", now)
+        received = timings.get("received")
+        root = self.tracer.start_span(
+            f"llamaxing {endpoint}",
+            kind=trace.SpanKind.SERVER,
+            start_time=ns(received)
+            if received is not None
+            else int(start_time.timestamp() * 1e9),
+            attributes={
+                **attributes,
+                "enduser.id": identity.id,
+                "gen_ai.response.model": (
+                    (response.get("model") or "") if isinstance(response, dict) else ""
+                ),
+                "gen_ai.usage.input_tokens": usage.get("prompt_tokens") or 0,
+                "gen_ai.usage.output_tokens": usage.get("completion_tokens") or 0,
+            },
+        )
+        context = trace.set_span_in_context(root)
+
+        def span(name, start, end, parent=context, **kwargs):
+            if start is None or end is None:
+                return None
+            child = self.tracer.start_span(
+                name, context=parent, start_time=ns(start), **kwargs
+            )
+            child.end(end_time=ns(end))
+            return child
+
+        span("auth", received, timings.get("authenticated"))
+        span("rate_limit", timings.get("authenticated"), timings.get("admitted"))
+        upstream_start = timings.get("upstream_start")
+        span("dispatch", timings.get("dispatch"), upstream_start)
+        latency = timings.get("latency")
+        if upstream_start is not None and latency is not None:
+            upstream_end = upstream_start + latency
+            upstream = self.tracer.start_span(
+                "upstream",
+                context=context,
+                kind=trace.SpanKind.CLIENT,
+                start_time=ns(upstream_start),
+                attributes=attributes,
+            )
+            upstream_context = trace.set_span_in_context(upstream)
+            pool_wait = timings.get("pool_wait")
+            if pool_wait is not None:
+                span(
+                    "pool_wait",
+                    upstream_start,
+                    upstream_start + pool_wait,
+                    upstream_context,
+                )
+            connect_start = timings.get("connect_start")
+            if connect_start is not None and timings.get("connect") is not None:
+                span(
+                    "connect",
+                    connect_start,
+                    connect_start + timings["connect"],
+                    upstream_context,
+                )
+            ttfb = timings.get("ttfb")
+            if ttfb is not None:
+                first_byte = upstream_start + ttfb
+                span("ttfb", upstream_start, first_byte, upstream_context)
+                if request.get("stream") is True:
+                    span("stream", first_byte, upstream_end, upstream_context)
+            upstream.end(end_time=ns(upstream_end))
+            span("background", upstream_end, observed)
+            self.upstream_duration.record(latency, attributes)
+            if ttfb is not None:
+                self.upstream_ttfb.record(ttfb, attributes)
+            if pool_wait is not None:
+                self.upstream_pool_wait.record(pool_wait, attributes)
+        root.end(end_time=ns(observed))
+
+        if received is not None:
+            self.request_duration.record(observed - received, attributes)
+        if timings.get("status_code") is not None:
+            self.upstream_responses.add(1, attributes)
+        for key, token_type in (
+            ("prompt_tokens", "input"),
+            ("completion_tokens", "output"),
+        ):
+            if usage.get(key) is not None:
+                self.tokens.record(
+                    usage[key], {**attributes, "gen_ai.token.type": token_type}
+                )
+
+    async def completions(
+        self,
+        identity: Identity,
+        metadata: dict,
+        request: dict,
+        response: dict,
+        start_time: datetime,
+        end_time: datetime,
+        completion_start_time: datetime | None = None,
+        timings: dict | None = None,
+    ):
+        try:
+            self.observe(
+                "completions",
+                identity,
+                request,
+                response,
+                start_time,
+                end_time,
+                timings,
+            )
+        except Exception:
+            log_exception()
+
+    async def chat_completions(
+        self,
+        identity: Identity,
+        metadata: dict,
+        request: dict,
+        response: dict,
+        start_time: datetime,
+        end_time: datetime,
+        completion_start_time: datetime | None = None,
+        timings: dict | None = None,
+    ):
+        try:
+            self.observe(
+                "chat_completions",
+                identity,
+                request,
+                response,
+                start_time,
+                end_time,
+                timings,
+            )
+        except Exception:
+            log_exception()
+
+    async def embeddings(
+        self,
+        identity: Identity,
+        metadata: dict,
+        request: dict,
+        response: dict,
+        start_time: datetime,
+        end_time: datetime,
+        completion_start_time: datetime | None = None,
+        timings: dict | None = None,
+    ):
+        try:
+            self.observe(
+                "embeddings",
+                identity,
+                request,
+                response,
+                start_time,
+                end_time,
+                timings,
+            )
+        except Exception:
+            log_exception()
+
+    async def images_generations(
+        self,
+        identity: Identity,
+        metadata: dict,
+        request: dict,
+        response: dict,
+        start_time: datetime,
+        end_time: datetime,
+        completion_start_time: datetime | None = None,
+        timings: dict | None = None,
+    ):
+        try:
+            self.observe(
+                "images_generations",
+                identity,
+                request,
+                response,
+                start_time,
+                end_time,
+                timings,
+            )
+        except Exception:
+            log_exception()
@@ -0,0 +1 @@
+from .interface import RateLimiterInterface  # noqa: F401
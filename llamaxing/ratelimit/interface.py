@@ -0,0 +1,22 @@
+from abc import ABC, abstractmethod
+
+from identity import Identity
+
+
+class RateLimiterInterface(ABC):
+    @abstractmethod
+    def __init__(self) -> None:
+        pass
+
+    @abstractmethod
+    async def on_shutdown(self):
+        pass
+
+    @abstractmethod
+    async def check(self, identity: Identity) -> float | None:
+        """Admit a request, or return the number of seconds to wait before retrying."""
+        pass
+
+    @abstractmethod
+    def consume_tokens(self, identity: Identity, tokens: int):
+        pass
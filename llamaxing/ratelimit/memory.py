@@ -0,0 +1,79 @@
+from time import monotonic
+
+from identity import Identity
+from ratelimit import RateLimiterInterface
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, rate: float) -> None:
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost: float, required: float) -> float | None:
+        self.refill()
+        if self.level < required:
+            return (required - self.level) / self.rate
+        self.level -= cost
+        return None
+
+
+class RateLimiter(RateLimiterInterface):
+    """Token buckets kept in process memory, i.e. per worker."""
+
+    def __init__(self) -> None:
+        self.request_buckets = {}
+        self.token_buckets = {}
+
+    async def on_shutdown(self):
+        pass
+
+    def get_bucket(self, buckets: dict, key: str, capacity: float, rate: float):
+        bucket = buckets.get(key)
+        if bucket is None or bucket.capacity != capacity or bucket.rate != rate:
+            bucket = buckets[key] = TokenBucket(capacity, rate)
+        return bucket
+
+    async def check(self, identity: Identity) -> float | None:
+        limits = identity.rate_limits
+        if limits is None:
+            return None
+        if limits.tokens_per_minute is not None:
+            bucket = self.get_bucket(
+                self.token_buckets,
+                identity.id,
+                limits.tokens_per_minute,
+                limits.tokens_per_minute / 60,
+            )
+            # Token usage is only known afterwards, so admit while budget remains
+            retry_after = bucket.take(0, 1)
+            if retry_after is not None:
+                return retry_after
+        if limits.requests_per_second is not None:
+            bucket = self.get_bucket(
+                self.request_buckets,
+                identity.id,
+                limits.burst or max(1, limits.requests_per_second),
+                limits.requests_per_second,
+            )
+            return bucket.take(1, 1)
+        return None
+
+    def consume_tokens(self, identity: Identity, tokens: int):
+        limits = identity.rate_limits
+        if limits is None or limits.tokens_per_minute is None:
+            return
+        bucket = self.get_bucket(
+            self.token_buckets,
+            identity.id,
+            limits.tokens_per_minute,
+            limits.tokens_per_minute / 60,
+        )
+        bucket.refill()
+        bucket.level -= tokens
@@ -0,0 +1,16 @@
+from identity import Identity
+from ratelimit import RateLimiterInterface
+
+
+class RateLimiter(RateLimiterInterface):
+    def __init__(self) -> None:
+        pass
+
+    async def on_shutdown(self):
+        pass
+
+    async def check(self, identity: Identity) -> float | None:
+        return None
+
+    def consume_tokens(self, identity: Identity, tokens: int):
+        pass
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import redis.asyncio as redis
+from identity import Identity
+from identity.identity import RateLimitConfig
+from logging_utils import log_exception
+from ratelimit import RateLimiterInterface
+from settings import settings
+
+# Refills the bucket stored at KEYS[1] and takes ARGV[4] from it if at least
+# ARGV[5] is available (or unconditionally if ARGV[6] is set). Returns the
+# number of seconds to wait before enough is available.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local required = tonumber(ARGV[5])
+local bucket = redis.call("HMGET", KEYS[1], "level", "updated")
+local level = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+level = math.min(capacity, level + math.max(0, now - updated) * rate)
+local wait = 0
+if level >= required or ARGV[6] == "1" then
+    level = level - cost
+else
+    wait = (required - level) / rate
+end
+redis.call("HSET", KEYS[1], "level", tostring(level), "updated", ARGV[3])
+redis.call("EXPIRE", KEYS[1], math.ceil((capacity - math.min(level, 0)) / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimiter(RateLimiterInterface):
+    """Token buckets shared by all workers through Redis."""
+
+    def __init__(self, client: redis.Redis | None = None) -> None:
+        if client is None:
+            client = redis.from_url(settings.rate_limiter_redis_url)
+        self.client = client
+        self.script = self.client.register_script(TOKEN_BUCKET_SCRIPT)
+        self.pending = set()
+
+    async def on_shutdown(self):
+        if len(self.pending) > 0:
+            await asyncio.wait(self.pending, timeout=5)
+        await self.client.aclose()
+
+    async def take(
+        self,
+        key: str,
+        capacity: float,
+        rate: float,
+        cost: float,
+        required: float,
+        force: bool = False,
+    ) -> float | None:
+        wait = await self.script(
+            keys=[f"{settings.rate_limiter_redis_prefix}:{key}"],
+            args=[capacity, rate, time.time(), cost, required, int(force)],
+        )
+        wait = float(wait)
+        return wait if wait > 0 else None
+
+    async def check(self, identity: Identity) -> float | None:
+        limits = identity.rate_limits
+        if limits is None:
+            return None
+        try:
+            return await self.check_limits(identity.id, limits)
+        except Exception:
+            # Fail open rather than rejecting all traffic when Redis is unavailable
+            log_exception()
+            return None
+
+    async def check_limits(self, id: str, limits: RateLimitConfig) -> float | None:
+        if limits.tokens_per_minute is not None:
+            retry_after = await self.take(
+                f"{id}:tokens",
+                limits.tokens_per_minute,
+                limits.tokens_per_minute / 60,
+                0,
+                1,
+            )
+            if retry_after is not None:
+                return retry_after
+        if limits.requests_per_second is not None:
+            return await self.take(
+                f"{id}:requests",
+                limits.burst or max(1, limits.requests_per_second),
+                limits.requests_per_second,
+                1,
+                1,
+            )
+        return None
+
+    def consume_tokens(self, identity: Identity, tokens: int):
+        limits = identity.rate_limits
+        if limits is None or limits.tokens_per_minute is None:
+            return
+        # Usage is reported once the response is done, so don't make the caller
+        # wait for Redis
+        task = asyncio.get_running_loop().create_task(
+            self.take(
+                f"{identity.id}:tokens",
+                limits.tokens_per_minute,
+                limits.tokens_per_minute / 60,
+                tokens,
+                0,
+                force=True,
+            )
+        )
+        self.pending.add(task)
+        task.add_done_callback(self.on_consumed)
+
+    def on_consumed(self, task: asyncio.Task):
+        self.pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            try:
+                raise task.exception()
+            except Exception:
+                log_exception()
@@ -2,22 +2,36 @@ from contextlib import asynccontextmanager
 from importlib import import_module
 
 import httpx
+import json_codec
 import version
 from fastapi import FastAPI, HTTPException, Request
+from http_client import build_client
 from llm import (
     chat_completions_wrapper,
     completions_wrapper,
     embeddings_wrapper,
     images_generations_wrapper,
 )
+from llm.utils.body import read_request
 from logging_utils import log_exception
 from sidecar_settings import settings
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.requests_client = httpx.AsyncClient(
-        timeout=settings.sidecar_app_requests_timeout
+    app.requests_client, app.pool_stats = build_client(
+        {
+            "max_connections": settings.sidecar_app_requests_max_connections,
+            "max_keepalive_connections": (
+                settings.sidecar_app_requests_max_keepalive_connections
+            ),
+            "keepalive_expiry": settings.sidecar_app_requests_keepalive_expiry,
+            "http2": settings.sidecar_app_requests_http2,
+            "connect_timeout": settings.sidecar_app_requests_connect_timeout,
+            "read_timeout": settings.sidecar_app_requests_timeout,
+            "write_timeout": settings.sidecar_app_requests_write_timeout,
+            "pool_timeout": settings.sidecar_app_requests_pool_timeout,
+        }
     )
     auth_module = import_module(f"auth.sidecar.{settings.sidecar_auth_method}")
     app.authentication_client = auth_module.Authentication()
@@ -33,6 +47,7 @@ app = FastAPI(
     version=version.__version__,
     docs_url="/",
     redoc_url=None,
+    default_response_class=json_codec.CodecJSONResponse,
 )
 
 
@@ -41,7 +56,7 @@ app = FastAPI(
 async def chat_completions(request: Request):
     headers = await request.app.authentication_client.get_headers()
     try:
-        data = await request.json()
+        data = await read_request(request, settings.sidecar_app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -56,6 +71,8 @@ async def chat_completions(request: Request):
         )
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -66,7 +83,7 @@ async def chat_completions(request: Request):
 async def completions(request: Request):
     headers = await request.app.authentication_client.get_headers()
     try:
-        data = await request.json()
+        data = await read_request(request, settings.sidecar_app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -81,6 +98,8 @@ async def completions(request: Request):
         )
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -91,7 +110,7 @@ async def completions(request: Request):
 async def embeddings(request: Request):
     headers = await request.app.authentication_client.get_headers()
     try:
-        data = await request.json()
+        data = await read_request(request, settings.sidecar_app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -106,6 +125,8 @@ async def embeddings(request: Request):
         )
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -116,7 +137,7 @@ async def embeddings(request: Request):
 async def images_generations(request: Request):
     headers = await request.app.authentication_client.get_headers()
     try:
-        data = await request.json()
+        data = await read_request(request, settings.sidecar_app_raw_request_body)
     except Exception:
         log_exception()
         raise HTTPException(400, detail="Input not valid JSON") from None
@@ -131,6 +152,8 @@ async def images_generations(request: Request):
         )
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
@@ -144,14 +167,23 @@ async def models(request: Request):
         response = await request.app.requests_client.get(
             f"{settings.sidecar_upstream_url}/v1/models", headers=headers
         )
-        return response.json()
+        return json_codec.loads(response.content)
     except httpx.ReadTimeout:
         raise HTTPException(408) from None
+    except httpx.PoolTimeout:
+        raise HTTPException(503, detail="Upstream connection pool exhausted") from None
     except Exception:
         log_exception()
         raise HTTPException(500) from None
 
 
+@app.get("/admin/http_pool")
+async def admin_http_pool(request: Request):
+    if not settings.sidecar_app_admin_endpoints:
+        raise HTTPException(404)
+    return request.app.pool_stats.to_dict()
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -4,6 +4,15 @@ from pydantic_settings import BaseSettings
 class Settings(BaseSettings):
     sidecar_app_name: str = "llamaxing sidecar proxy"
     sidecar_app_requests_timeout: int = 300
+    sidecar_app_requests_connect_timeout: float = 10.0
+    sidecar_app_requests_write_timeout: float = 60.0
+    sidecar_app_requests_pool_timeout: float = 5.0
+    sidecar_app_requests_max_connections: int = 100
+    sidecar_app_requests_max_keepalive_connections: int = 20
+    sidecar_app_requests_keepalive_expiry: float = 30.0
+    sidecar_app_requests_http2: bool = False
+    sidecar_app_raw_request_body: bool = False
+    sidecar_app_admin_endpoints: bool = False
     sidecar_upstream_url: str
     sidecar_auth_method: str
     sidecar_auth_method_azure_scope: str | None = None
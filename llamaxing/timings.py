@@ -0,0 +1,32 @@
+from contextvars import ContextVar
+from time import perf_counter
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+# Timings of the phases of the request being handled: perf_counter marks of
+# when phases started and durations measured along the way
+request_timings: ContextVar[dict | None] = ContextVar("request_timings", default=None)
+
+
+def mark(name: str):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = perf_counter()
+
+
+def record(name: str, value: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = value
+
+
+class TimingMiddleware:
+    """Starts the timings of each HTTP request when it is received."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            request_timings.set({"received": perf_counter()})
+        await self.app(scope, receive, send)
@@ -0,0 +1,30 @@
+import importlib
+
+import pytest
+from fastapi import HTTPException
+from identity import Identity
+from settings import settings
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    (tmp_path / "models.json").write_text("[]")
+    monkeypatch.chdir(tmp_path)
+    return importlib.import_module("main")
+
+
+def test_admin_endpoints_disabled_by_default(main, monkeypatch):
+    monkeypatch.setattr(settings, "auth_method", "apikey")
+    with pytest.raises(HTTPException) as e:
+        main.admin(Identity(id="root", admin=True))
+    assert e.value.status_code == 404
+
+
+def test_admin_endpoints_require_admin_identity(main, monkeypatch):
+    monkeypatch.setattr(settings, "app_admin_endpoints", True)
+    monkeypatch.setattr(settings, "auth_method", "apikey")
+    with pytest.raises(HTTPException) as e:
+        main.admin(Identity(id="user"))
+    assert e.value.status_code == 403
+    identity = Identity(id="root", admin=True)
+    assert main.admin(identity) is identity
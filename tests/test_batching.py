@@ -0,0 +1,79 @@
+import asyncio
+
+import httpx
+import json_codec
+from llm.batching import EmbeddingBatcher, apportion
+
+
+def embedding_response(inputs: list, reverse: bool = False) -> httpx.Response:
+    data = [
+        {"object": "embedding", "index": i, "embedding": [float(len(x))]}
+        for i, x in enumerate(inputs)
+    ]
+    if reverse:
+        # Upstreams don't have to return the embeddings in input order
+        data.reverse()
+    tokens = sum(len(x) for x in inputs)
+    return httpx.Response(
+        200,
+        json={
+            "object": "list",
+            "data": data,
+            "model": "emb",
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        },
+    )
+
+
+def test_apportion_adds_up():
+    assert apportion(10, [1, 1, 1]) == [4, 3, 3]
+    assert sum(apportion(7, [5, 0, 2])) == 7
+
+
+def test_split_response_follows_index_order():
+    entries = [(["a", "bb"], None), (["ccc"], None), (["dddd", "e", "ff"], None)]
+    inputs = [x for items, _ in entries for x in items]
+    r = embedding_response(inputs, reverse=True)
+    responses = EmbeddingBatcher.split_response(r, entries)
+    bodies = [json_codec.loads(x.content) for x in responses]
+    assert [[x["embedding"][0] for x in body["data"]] for body in bodies] == [
+        [1.0, 2.0],
+        [3.0],
+        [4.0, 1.0, 2.0],
+    ]
+    assert [[x["index"] for x in body["data"]] for body in bodies] == [
+        [0, 1],
+        [0],
+        [0, 1, 2],
+    ]
+    assert [body["usage"]["total_tokens"] for body in bodies] == [3, 3, 7]
+
+
+def test_concurrent_requests_share_one_call():
+    requests = []
+
+    def handler(request):
+        inputs = json_codec.loads(request.content)["input"]
+        requests.append(inputs)
+        return embedding_response(inputs, reverse=True)
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        batcher = EmbeddingBatcher()
+        responses = await asyncio.gather(
+            *(
+                batcher.submit(
+                    {"model": "emb", "input": x}, "https://example.com", {}, client
+                )
+                for x in (["a", "bb"], "ccc", ["dddd"])
+            )
+        )
+        return [json_codec.loads(x.content)["data"] for x in responses]
+
+    data = asyncio.run(run())
+    assert len(requests) == 1
+    assert [[x["embedding"][0] for x in items] for items in data] == [
+        [1.0, 2.0],
+        [3.0],
+        [4.0],
+    ]
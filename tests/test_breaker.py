@@ -0,0 +1,65 @@
+import pytest
+from llm import breaker
+from llm.breaker import CircuitBreaker
+from settings import settings
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(breaker, "monotonic", lambda: now[0])
+    monkeypatch.setattr(settings, "llm_circuit_breaker_threshold", 2)
+    monkeypatch.setattr(settings, "llm_circuit_breaker_cooldown", 30.0)
+    monkeypatch.setattr(settings, "llm_circuit_breaker_probes", 1)
+    return now
+
+
+def trip(b: CircuitBreaker):
+    for _ in range(2):
+        b.on_request_end(False, b.on_request_start())
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    b = CircuitBreaker()
+    b.on_request_end(False, b.on_request_start())
+    assert b.state == CircuitBreaker.CLOSED
+    b.on_request_end(False, b.on_request_start())
+    assert b.state == CircuitBreaker.OPEN
+    assert not b.allow_request()
+    clock[0] = 10.0
+    assert b.open_for() == 20.0
+
+
+def test_breaker_closes_after_successful_probe(clock):
+    b = CircuitBreaker()
+    trip(b)
+    clock[0] = 30.0
+    assert b.allow_request()
+    assert b.state == CircuitBreaker.HALF_OPEN
+    probe = b.on_request_start()
+    assert probe
+    # Only one probe at a time
+    assert not b.allow_request()
+    b.on_request_end(True, probe)
+    assert b.state == CircuitBreaker.CLOSED
+    assert b.allow_request()
+
+
+def test_breaker_reopens_after_failed_probe(clock):
+    b = CircuitBreaker()
+    trip(b)
+    clock[0] = 30.0
+    assert b.allow_request()
+    b.on_request_end(False, b.on_request_start())
+    assert b.state == CircuitBreaker.OPEN
+    assert b.open_for() == 30.0
+
+
+def test_released_probe_frees_its_slot(clock):
+    b = CircuitBreaker()
+    trip(b)
+    clock[0] = 30.0
+    assert b.allow_request()
+    b.release(b.on_request_start())
+    assert b.state == CircuitBreaker.HALF_OPEN
+    assert b.allow_request()
@@ -0,0 +1,16 @@
+import asyncio
+
+from config_reload import ConfigReloader
+
+
+def test_unconfigured_files_are_skipped(tmp_path):
+    reloaded = []
+
+    async def reload():
+        reloaded.append(True)
+
+    filename = str(tmp_path / "models.json")
+    reloader = ConfigReloader({filename: reload, None: reload})
+    assert list(reloader.targets) == [filename]
+    asyncio.run(reloader.reload_all())
+    assert reloaded == [True]
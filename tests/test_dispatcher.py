@@ -0,0 +1,193 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from identity import Identity
+from llm import LLMDispatcher
+from llm.cache.interface import cache_key
+from llm.cache.memory import ResponseCache
+from llm.logging import LoggingClientInterface
+from settings import settings
+from starlette.responses import Response, StreamingResponse
+
+MODELS = [
+    {
+        "id": "gpt",
+        "capabilities": ["chat_completions"],
+        "load_balancing": "random",
+        "instances": [
+            {"id": "a", "provider": "openai", "openai_api_key": "key"},
+            {"id": "b", "provider": "openai", "openai_api_key": "key"},
+        ],
+    }
+]
+
+
+@pytest.fixture
+def dispatcher(tmp_path, monkeypatch):
+    (tmp_path / "models.json").write_text(json.dumps(MODELS))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, "llm_retry_backoff_base", 0.0)
+    return LLMDispatcher()
+
+
+def fake_upstream(dispatcher, results, delay=0.0):
+    """Make every instance answer with the next status code or exception."""
+    calls = []
+
+    async def call(data, identity, client, instance, logging, observability, tracker):
+        calls.append(instance.id)
+        await asyncio.sleep(delay)
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        await tracker.on_response(httpx.Response(result))
+        return Response(status_code=result)
+
+    for instance in dispatcher.instances.values():
+        instance.endpoints["chat_completions"] = call
+    return calls
+
+
+class ListLoggingClient(LoggingClientInterface):
+    def __init__(self) -> None:
+        self.calls = []
+
+    async def on_shutdown(self):
+        pass
+
+    async def log_api_call(self, endpoint, metadata, request, response):
+        self.calls.append((endpoint, metadata, request, response))
+
+
+def call(dispatcher, data=None, **kwargs):
+    return asyncio.run(
+        dispatcher.call(
+            "chat_completions",
+            data or {"model": "gpt"},
+            Identity(id="user"),
+            None,
+            **kwargs,
+        )
+    )
+
+
+def test_retry_uses_another_instance(dispatcher):
+    calls = fake_upstream(dispatcher, [503, 200])
+    response = call(dispatcher)
+    assert response.status_code == 200
+    assert len(calls) == 2
+    assert calls[0] != calls[1]
+
+
+def test_retries_are_cut_off_by_the_deadline(dispatcher, monkeypatch):
+    monkeypatch.setattr(settings, "llm_retry_max_attempts", 5)
+    monkeypatch.setattr(settings, "llm_retry_deadline", 0.15)
+    error = httpx.ConnectError("refused")
+    calls = fake_upstream(dispatcher, [error] * 5, delay=0.1)
+    with pytest.raises(httpx.ConnectError):
+        call(dispatcher)
+    assert len(calls) == 2
+
+
+def test_retries_give_up_after_max_attempts(dispatcher, monkeypatch):
+    monkeypatch.setattr(settings, "llm_retry_max_attempts", 2)
+    calls = fake_upstream(dispatcher, [503, 503, 200])
+    # The last attempt isn't retryable, its response is passed on as is
+    response = call(dispatcher)
+    assert response.status_code == 503
+    assert len(calls) == 2
+
+
+def test_no_retry_after_first_streamed_byte(dispatcher):
+    calls = []
+
+    async def content():
+        yield b"data: {}\n\n"
+        raise httpx.ReadError("connection reset")
+
+    async def stream(data, identity, client, instance, logging, observability, tracker):
+        calls.append(instance.id)
+        await tracker.on_response(httpx.Response(200), stream=True)
+        return StreamingResponse(content(), media_type="text/event-stream")
+
+    for instance in dispatcher.instances.values():
+        instance.endpoints["chat_completions"] = stream
+
+    async def consume():
+        response = await dispatcher.call(
+            "chat_completions",
+            {"model": "gpt", "stream": True},
+            Identity(id="user"),
+            None,
+        )
+        return [chunk async for chunk in response.body_iterator]
+
+    with pytest.raises(httpx.ReadError):
+        asyncio.run(consume())
+    assert len(calls) == 1
+
+
+def test_reload_updates_quotas_only_for_valid_tables(dispatcher, tmp_path):
+    stats = dispatcher.instances["a"].stats
+    models = json.loads(json.dumps(MODELS))
+    models[0]["instances"][0]["tpm"] = 1000
+    duplicate = {**models[0], "instances": models[0]["instances"][:1]}
+    (tmp_path / "models.json").write_text(json.dumps([*models, duplicate]))
+    with pytest.raises(ValueError):
+        asyncio.run(dispatcher.reload_models())
+    assert stats.quota.tpm is None
+
+    (tmp_path / "models.json").write_text(json.dumps(models))
+    asyncio.run(dispatcher.reload_models())
+    assert dispatcher.instances["a"].stats is stats
+    assert stats.quota.tpm == 1000
+
+
+def test_cache_hits_are_logged(dispatcher):
+    calls = fake_upstream(dispatcher, [])
+    cache = ResponseCache()
+    logging_client = ListLoggingClient()
+    data = {"model": "gpt", "temperature": 0, "messages": []}
+    cached = {"object": "chat.completion", "choices": []}
+    key = cache_key("chat_completions", "gpt", data)
+    asyncio.run(cache.set(key, json.dumps(cached).encode()))
+
+    response = call(
+        dispatcher, data, logging_client=logging_client, response_cache=cache
+    )
+    assert response.headers["X-Cache"] == "HIT"
+    asyncio.run(response.background())
+    assert calls == []
+    [(endpoint, metadata, request, logged)] = logging_client.calls
+    assert endpoint == "chat_completions"
+    assert metadata["cache"] == "HIT"
+    assert logged == cached
+
+
+def test_non_deterministic_requests_are_not_cached(dispatcher, monkeypatch):
+    calls = fake_upstream(dispatcher, [200, 200])
+    cache = ResponseCache()
+    data = {"model": "gpt", "temperature": 1, "messages": []}
+    key = cache_key("chat_completions", "gpt", data)
+    asyncio.run(cache.set(key, b"{}"))
+
+    assert "X-Cache" not in call(dispatcher, data, response_cache=cache).headers
+    assert len(calls) == 1
+    monkeypatch.setattr(settings, "response_cache_non_deterministic", True)
+    assert call(dispatcher, data, response_cache=cache).headers["X-Cache"] == "HIT"
+    assert len(calls) == 1
+
+
+def test_pool_timeout_is_not_held_against_the_instance(dispatcher):
+    calls = fake_upstream(dispatcher, [httpx.PoolTimeout("pool exhausted")])
+    with pytest.raises(HTTPException) as e:
+        call(dispatcher)
+    assert e.value.status_code == 503
+    assert len(calls) == 1
+    stats = dispatcher.instances[calls[0]].stats
+    assert stats.errors == 0
+    assert stats.in_flight == 0
+    assert stats.breaker.consecutive_failures == 0
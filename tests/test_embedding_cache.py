@@ -0,0 +1,45 @@
+import asyncio
+
+import json_codec
+from llm.cache.embeddings import cached_embeddings
+from llm.cache.memory import ResponseCache
+from starlette.responses import Response
+
+
+def fake_upstream(requests):
+    async def forward(data):
+        requests.append(data["input"])
+        body = {
+            "data": [
+                {"index": i, "embedding": [float(len(x))]}
+                for i, x in enumerate(data["input"])
+            ],
+            "model": "emb",
+            "usage": {"prompt_tokens": 1, "total_tokens": 1},
+        }
+        return Response(json_codec.dumps(body), media_type="application/json")
+
+    return forward
+
+
+def embed(cache, forward, inputs):
+    data = {"model": "emb", "input": inputs}
+    response = asyncio.run(cached_embeddings(data, "emb", cache, forward))
+    return response.headers["X-Cache"], [
+        x["embedding"] for x in json_codec.loads(response.body)["data"]
+    ]
+
+
+def test_repeated_inputs_are_sent_once():
+    cache = ResponseCache()
+    requests = []
+    forward = fake_upstream(requests)
+    status, vectors = embed(cache, forward, ["a", "a", "bb"])
+    assert status == "MISS"
+    assert vectors == [[1.0], [1.0], [2.0]]
+    assert requests == [["a", "bb"]]
+
+    status, vectors = embed(cache, forward, ["ccc", "a", "ccc"])
+    assert status == "PARTIAL"
+    assert vectors == [[3.0], [1.0], [3.0]]
+    assert requests[-1] == ["ccc"]
@@ -0,0 +1,35 @@
+import asyncio
+
+import httpx
+import pytest
+from llm.instance import InstanceStats, RequestTracker, RetryableUpstreamError
+
+
+def test_failed_attempt_releases_reserved_tokens():
+    stats = InstanceStats("a", 1000, None)
+    tracker = RequestTracker(stats, tokens=100)
+    assert stats.quota.tokens.total() == 100
+    tracker.finish(error=True)
+    assert stats.quota.tokens.total() == 0
+    assert stats.quota.requests.total() == 1
+
+
+def test_retryable_status_releases_reserved_tokens():
+    stats = InstanceStats("a", 1000, None)
+    tracker = RequestTracker(stats, retryable=True, tokens=100)
+    response = httpx.Response(429, headers={"Retry-After": "1"})
+    with pytest.raises(RetryableUpstreamError):
+        asyncio.run(tracker.on_response(response))
+    assert stats.quota.tokens.total() == 0
+    # Usage reported afterwards must not be subtracted a second time
+    tracker.record_usage({"total_tokens": 40})
+    assert stats.quota.tokens.total() == 0
+
+
+def test_successful_attempt_is_reconciled_with_usage():
+    stats = InstanceStats("a", 1000, None)
+    tracker = RequestTracker(stats, tokens=100)
+    asyncio.run(tracker.on_response(httpx.Response(200)))
+    assert stats.quota.tokens.total() == 100
+    tracker.record_usage({"total_tokens": 40})
+    assert stats.quota.tokens.total() == 40
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("motor.motor_asyncio", exc_type=ImportError)
+
+from llm.logging import mongodb  # noqa: E402
+from settings import settings  # noqa: E402
+
+
+class FakeCollection:
+    def __init__(self) -> None:
+        self.records = []
+
+    async def insert_many(self, records, ordered=True):
+        self.records.extend(records)
+
+
+def test_flusher_survives_idle_interval(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "logging_client_mongodb_flush_interval", 0.05)
+    monkeypatch.setattr(settings, "logging_client_mongodb_batch_size", 100)
+    monkeypatch.setattr(
+        settings, "logging_client_mongodb_spill_path", str(tmp_path / "spill.jsonl")
+    )
+
+    async def run():
+        client = mongodb.LoggingClient()
+        client.collection = FakeCollection()
+        await client.on_startup()
+        # Idle for a few flush intervals before anything is logged
+        await asyncio.sleep(0.2)
+        assert not client.task.done()
+        await client.log_api_call("chat_completions", {}, {"model": "x"}, {})
+        await asyncio.sleep(0.2)
+        assert len(client.collection.records) == 1
+        assert client.get_stats()["written"] == 1
+        await client.on_shutdown()
+
+    asyncio.run(run())
+
+
+def test_records_are_spooled_before_returning(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "logging_client_mongodb_flush_interval", 0.05)
+    monkeypatch.setattr(settings, "logging_client_mongodb_spool", True)
+    monkeypatch.setattr(
+        settings, "logging_client_mongodb_spool_path", str(tmp_path / "spool")
+    )
+    monkeypatch.setattr(settings, "logging_client_mongodb_spool_fsync", False)
+    monkeypatch.setattr(
+        settings, "logging_client_mongodb_spill_path", str(tmp_path / "spill.jsonl")
+    )
+
+    async def run():
+        client = mongodb.LoggingClient()
+        client.collection = FakeCollection()
+        await client.on_startup()
+        await client.log_api_call("chat_completions", {}, {"model": "x"}, {})
+        assert client.get_stats()["spooled"] == 1
+        assert client.spool.size() > 0
+        await asyncio.sleep(0.2)
+        assert len(client.collection.records) == 1
+        await client.on_shutdown()
+
+    asyncio.run(run())
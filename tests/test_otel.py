@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime, timezone
+from time import perf_counter
+
+import pytest
+
+pytest.importorskip("opentelemetry.sdk")
+
+from identity import Identity  # noqa: E402
+from observability.otel import ObservabilityClient  # noqa: E402
+from opentelemetry.sdk.metrics.export import InMemoryMetricReader  # noqa: E402
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (  # noqa: E402
+    InMemorySpanExporter,
+)
+from opentelemetry.trace import SpanKind  # noqa: E402
+
+
+def test_chat_completion_trace_and_metrics():
+    spans, reader = InMemorySpanExporter(), InMemoryMetricReader()
+    client = ObservabilityClient(span_exporter=spans, metric_reader=reader)
+    received = perf_counter() - 1.0
+    timings = {
+        "received": received,
+        "authenticated": received + 0.01,
+        "admitted": received + 0.02,
+        "dispatch": received + 0.03,
+        "upstream_start": received + 0.05,
+        "pool_wait": 0.01,
+        "connect_start": received + 0.06,
+        "connect": 0.04,
+        "ttfb": 0.3,
+        "latency": 0.8,
+        "instance": "a",
+        "status_code": 200,
+        "observed": received + 0.9,
+    }
+    now = datetime.now(timezone.utc)
+
+    async def run():
+        await client.chat_completions(
+            Identity(id="user"),
+            None,
+            {"model": "gpt", "messages": []},
+            {
+                "model": "gpt-0613",
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5},
+            },
+            now,
+            now,
+            timings=timings,
+        )
+        metrics = reader.get_metrics_data()
+        await client.on_shutdown()
+        return metrics
+
+    metrics = asyncio.run(run())
+    finished = {x.name: x for x in spans.get_finished_spans()}
+    assert set(finished) == {
+        "llamaxing chat_completions",
+        "auth",
+        "rate_limit",
+        "dispatch",
+        "upstream",
+        "pool_wait",
+        "connect",
+        "ttfb",
+        "background",
+    }
+    root = finished["llamaxing chat_completions"]
+    assert root.kind == SpanKind.SERVER
+    assert root.attributes["enduser.id"] == "user"
+    assert root.attributes["gen_ai.request.model"] == "gpt"
+    assert root.attributes["gen_ai.response.model"] == "gpt-0613"
+    assert root.attributes["gen_ai.usage.input_tokens"] == 10
+    assert root.attributes["gen_ai.usage.output_tokens"] == 5
+    upstream = finished["upstream"]
+    assert upstream.kind == SpanKind.CLIENT
+    assert upstream.parent.span_id == root.context.span_id
+    assert upstream.attributes["llamaxing.instance"] == "a"
+    assert upstream.attributes["http.response.status_code"] == 200
+    assert finished["ttfb"].parent.span_id == upstream.context.span_id
+
+    def duration(name):
+        span = finished[name]
+        return (span.end_time - span.start_time) / 1e9
+
+    for name, expected in (
+        ("llamaxing chat_completions", 0.9),
+        ("auth", 0.01),
+        ("dispatch", 0.02),
+        ("upstream", 0.8),
+        ("pool_wait", 0.01),
+        ("connect", 0.04),
+        ("ttfb", 0.3),
+        ("background", 0.05),
+    ):
+        assert duration(name) == pytest.approx(expected, abs=1e-3)
+    assert finished["upstream"].start_time - root.start_time == pytest.approx(
+        0.05e9, abs=1e6
+    )
+
+    recorded = {
+        m.name: m.data.data_points
+        for rm in metrics.resource_metrics
+        for sm in rm.scope_metrics
+        for m in sm.metrics
+    }
+    [point] = recorded["llamaxing.upstream.duration"]
+    assert point.count == 1
+    assert point.sum == pytest.approx(0.8)
+    assert {
+        x.attributes["gen_ai.token.type"]: x.sum for x in recorded["llamaxing.tokens"]
+    } == {
+        "input": 10,
+        "output": 5,
+    }
+    [point] = recorded["llamaxing.upstream.responses"]
+    assert point.value == 1
@@ -0,0 +1,41 @@
+import asyncio
+
+import pyarrow.parquet as pq
+from llm.logging import parquet
+from settings import settings
+
+
+def test_writer_survives_idle_interval(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "logging_client_parquet_path", str(tmp_path))
+    monkeypatch.setattr(settings, "logging_client_parquet_flush_interval", 0.05)
+
+    async def run():
+        client = parquet.LoggingClient()
+        await client.on_startup()
+        # Idle for a few flush intervals before anything is logged
+        await asyncio.sleep(0.2)
+        assert not client.task.done()
+        await client.log_api_call("chat_completions", {}, {"model": "x"}, {})
+        await asyncio.sleep(0.3)
+        assert client.get_stats()["written"] == 1
+        await client.on_shutdown()
+
+    asyncio.run(run())
+    files = list(tmp_path.glob("date=*/*.parquet"))
+    assert len(files) == 1
+    assert pq.read_table(files[0]).column("model").to_pylist() == ["x"]
+
+
+def test_buffer_is_bounded(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "logging_client_parquet_path", str(tmp_path))
+    monkeypatch.setattr(settings, "logging_client_parquet_max_rows", 2)
+
+    async def run():
+        client = parquet.LoggingClient()
+        for _ in range(3):
+            await client.log_api_call("embeddings", {}, {"model": "x"}, {})
+        return client.get_stats()
+
+    stats = asyncio.run(run())
+    assert stats["buffered"] == 2
+    assert stats["dropped"] == 1
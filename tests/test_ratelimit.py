@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+from identity import Identity
+from identity.identity import RateLimitConfig
+from ratelimit import memory
+from ratelimit import redis as redis_limiter
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(memory, "monotonic", clock)
+    monkeypatch.setattr(redis_limiter, "time", clock)
+    return clock
+
+
+def memory_limiter():
+    return memory.RateLimiter()
+
+
+def fake_redis_limiter():
+    fakeredis = pytest.importorskip("fakeredis")
+    return redis_limiter.RateLimiter(fakeredis.FakeAsyncRedis())
+
+
+LIMITERS = [memory_limiter, fake_redis_limiter]
+
+
+def identity(**limits) -> Identity:
+    return Identity(id="user", rate_limits=RateLimitConfig(**limits))
+
+
+@pytest.mark.parametrize("factory", LIMITERS)
+def test_requests_burst_and_refill(factory, clock):
+    user = identity(requests_per_second=2, burst=3)
+
+    async def run():
+        limiter = factory()
+        for _ in range(3):
+            assert await limiter.check(user) is None
+        assert await limiter.check(user) == pytest.approx(0.5)
+        clock.now += 0.5
+        assert await limiter.check(user) is None
+        assert await limiter.check(user) == pytest.approx(0.5)
+        await limiter.on_shutdown()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("factory", LIMITERS)
+def test_tokens_charged_after_the_response(factory, clock):
+    user = identity(tokens_per_minute=600)
+
+    async def run():
+        limiter = factory()
+        assert await limiter.check(user) is None
+        limiter.consume_tokens(user, 700)
+        # The redis limiter charges in the background
+        await asyncio.sleep(0)
+        if hasattr(limiter, "pending"):
+            await asyncio.gather(*limiter.pending)
+        # 100 tokens in debt, refilled at 10 per second until 1 is available
+        assert await limiter.check(user) == pytest.approx(10.1)
+        clock.now += 10.1
+        assert await limiter.check(user) is None
+        await limiter.on_shutdown()
+
+    asyncio.run(run())
+
+
+def test_redis_fails_open(clock):
+    async def unavailable(**kwargs):
+        raise ConnectionError("Redis is down")
+
+    async def run():
+        limiter = fake_redis_limiter()
+        limiter.script = unavailable
+        user = identity(requests_per_second=1, tokens_per_minute=60)
+        assert await limiter.check(user) is None
+        limiter.consume_tokens(user, 100)
+        await asyncio.gather(*limiter.pending, return_exceptions=True)
+        assert len(limiter.pending) == 0
+        await limiter.on_shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,47 @@
+import json
+
+from llm.utils.sse import StreamAccumulator
+
+
+def event(data) -> bytes:
+    return b"data: " + json.dumps(data).encode() + b"\n\n"
+
+
+CHUNK = {
+    "id": "x",
+    "object": "chat.completion.chunk",
+    "model": "gpt-4",
+    "choices": [{"index": 0, "delta": {"content": "Hi"}, "finish_reason": "stop"}],
+}
+USAGE = {
+    "id": "x",
+    "object": "chat.completion.chunk",
+    "model": "gpt-4",
+    "choices": [],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4},
+}
+
+
+def test_flush_forwards_unterminated_final_event():
+    accumulator = StreamAccumulator(drop_usage_chunk=True)
+    forwarded = accumulator.feed(event(CHUNK) + event(USAGE) + b"data: [DONE]\n")
+    assert forwarded == event(CHUNK)
+    assert accumulator.flush() == b"data: [DONE]\n"
+    response = accumulator.result()
+    assert response["stream_merge_successful"]
+    assert response["usage"]["total_tokens"] == 4
+
+
+def test_flush_forwards_non_sse_bytes():
+    accumulator = StreamAccumulator(drop_usage_chunk=True)
+    assert accumulator.feed(b"\x1f\x8b\x08compressed") == b""
+    assert accumulator.flush() == b"\x1f\x8b\x08compressed"
+    assert accumulator.flush() == b""
+
+
+def test_flush_without_drop_usage_chunk_forwards_nothing():
+    accumulator = StreamAccumulator()
+    data = event(CHUNK) + b"data: [DONE]"
+    assert accumulator.feed(data) == data
+    assert accumulator.flush() == b""
+    assert accumulator.result()["stream_merge_successful"]
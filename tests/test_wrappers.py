@@ -0,0 +1,29 @@
+import asyncio
+
+import httpx
+from llm.instance import InstanceStats
+from llm.wrappers import images_generations_wrapper
+
+
+def test_images_generations_response_is_recorded():
+    body = {"created": 1, "data": [{"url": "https://example.com/image.png"}]}
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(200, json=body))
+    )
+    recorded = []
+    stats = InstanceStats("a")
+    tracker = stats.start_request(response_callback=recorded.append)
+
+    async def run():
+        response = await images_generations_wrapper(
+            {"prompt": "a llama"},
+            "https://example.com/v1/images/generations",
+            {},
+            client,
+            tracker=tracker,
+        )
+        await response.background()
+
+    asyncio.run(run())
+    assert recorded == [body]
+    assert stats.in_flight == 0